@@ -5,8 +5,16 @@ Usage:
     python setup.py py2app
 """
 
+import os
+import sys
 from setuptools import setup
 
+# Packaged builds serve the player page from one archive, built here.
+if any(arg.startswith(('py2app', 'bdist', 'sdist')) for arg in sys.argv[1:]):
+    sys.path.insert(0, os.path.join('src', 'hero_init'))
+    from static_bundle import build_bundle
+    build_bundle('src/hero_init/_static', 'src/hero_init/_static.zip')
+
 APP = ['src/hero_init/__main__.py']
 DATA_FILES = ['src/hero_init']
 OPTIONS = {'argv_emulation': True}
@@ -22,6 +30,7 @@ setup(
     packages=['hero_init', 'hero_init.ui'],
     package_dir={'': 'src'},
     package_data={'hero_init': [
+        '_static.zip',
         '_static/*.html',
         '_static/bootstrap/css/*.css',
         '_static/bootstrap/img/*.png',
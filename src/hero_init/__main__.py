@@ -22,5 +22,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import sys
+
+# Packaged apps start the player server process by running themselves.
+if sys.argv[1:2] == ["--snapshot-server"]:
+    import snapshot_server
+    snapshot_server.main(sys.argv[1:])
+    sys.exit(0)
+
+# Time imports from the very start, so that the report covers them all.
+if "--startup-profile" in sys.argv:
+    sys.argv.remove("--startup-profile")
+    import startup_profile
+    startup_profile.install()
+
 from main_window import main
 main()
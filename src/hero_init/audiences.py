@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# audiences.py: What each kind of viewer may see of a combat.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+from combat_model import CombatantGroup, States
+
+## CONSTANTS ###################################################################
+
+# Fields of a combatant, as serialized by combatant_fields.
+ALL_FIELDS = (
+    'name', 'spd', 'dex', 'stun', 'body', 'end', 'rec', 'seg', 'status',
+    'kind', 'current', 'count'
+)
+# Everything but the numbers, which "health" and "conditions" stand in for.
+SUMMARY_FIELDS = (
+    'name', 'kind', 'seg', 'status', 'current', 'count', 'health', 'conditions'
+)
+# How others see NPCs: without their names, SPD or phases, so as to keep
+# surprises. As in /api/forecast and the player window, only the GM knows
+# which NPC is which.
+GLIMPSE_FIELDS = ('kind', 'current', 'count', 'health', 'conditions')
+
+# Fraction of STUN or BODY left below which a combatant is "badly wounded".
+BADLY_WOUNDED = 0.5
+
+# Audiences that are always there, and can't be removed.
+BUILTIN = ("gm", "players", "spectators", "pcs")
+
+# One audience's view of the combat at some model version: the list of
+# combatants, those it can see the names of keyed by name as well, and the
+# list serialized as JSON.
+Projection = namedtuple("Projection", "version combatants by_name json")
+
+## CLASSES #####################################################################
+
+class Audience(object):
+    """
+    Someone looking at the combat, and what they may see of it.
+    
+    ``rules`` is a list of ``(matches, fields)`` pairs. The first rule whose
+    ``matches`` returns ``True`` for a combatant decides which ``fields`` of
+    it are shown; combatants matching no rule aren't shown at all. Fields
+    are those of :data:`ALL_FIELDS`, along with the derived ``"health"`` and
+    ``"conditions"``. Private audiences are only served to clients holding
+    the API token.
+    """
+    def __init__(self, name, rules, private=False, description=""):
+        self.name = name
+        self.rules = rules
+        self.private = private
+        self.description = description
+        
+    def view(self, combatant, fields):
+        """
+        Returns what this audience sees of a combatant, given all of its
+        ``fields``, or ``None`` if the combatant is hidden from it.
+        """
+        for matches, shown in self.rules:
+            if matches(combatant):
+                return dict(
+                    (field, DERIVED[field](combatant, fields) if field in DERIVED else fields[field])
+                    for field in shown
+                    if field in fields or field in DERIVED
+                )
+        return None
+        
+    def project(self, entries):
+        """
+        Returns what this audience sees of each ``(combatant, fields)`` pair.
+        """
+        views = (self.view(combatant, fields) for combatant, fields in entries)
+        return [view for view in views if view is not None]
+        
+class Audiences(object):
+    """
+    The audiences served by the webserver, by name. Changed from the GUI
+    thread and read from server threads, so each change swaps in a new
+    dictionary rather than modifying the one being read.
+    """
+    def __init__(self):
+        self._by_name = OrderedDict(
+            (audience.name, audience)
+            for audience in (gm(), players(), spectators(), pcs())
+        )
+        
+    def __contains__(self, name):
+        return name in self._by_name
+        
+    def __iter__(self):
+        return iter(self._by_name.values())
+        
+    def get(self, name):
+        return self._by_name.get(name)
+        
+    def add(self, audience):
+        if audience.name in BUILTIN:
+            raise RuntimeError(u"Can't replace the {} audience.".format(audience.name))
+        by_name = OrderedDict(self._by_name)
+        by_name[audience.name] = audience
+        self._by_name = by_name
+        
+    def remove(self, name):
+        if name in BUILTIN:
+            raise RuntimeError(u"Can't remove the {} audience.".format(name))
+        if name not in self._by_name:
+            raise RuntimeError(u"No such audience {}.".format(name))
+        by_name = OrderedDict(self._by_name)
+        del by_name[name]
+        self._by_name = by_name
+        
+class Projections(object):
+    """
+    Each audience's view of the combat, computed on first request after the
+    model changes and then served to every client of that audience. The
+    combatants are serialized once per model version and shared by all
+    audiences, so more clients cost nothing more, and each extra audience
+    only costs applying its rules.
+    """
+    def __init__(self, model, audiences):
+        self._model = model
+        self._audiences = audiences
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = None
+        # Maps audience names to the audience and its projection.
+        self._cache = {}
+        
+    @property
+    def audiences(self):
+        return self._audiences
+        
+    def get(self, name):
+        """
+        Returns the current :data:`Projection` for the named audience, or
+        ``None`` if there is no such audience.
+        """
+        audience = self._audiences.get(name)
+        if audience is None:
+            return None
+        # Clients asking at once wait for one projection, rather than each
+        # computing their own.
+        with self._lock:
+            # Read the version first: the projection is then at least as new
+            # as the version it is filed under.
+            version = self._model.version
+            if version != self._version:
+                self._version = version
+                self._entries = None
+                self._cache.clear()
+            cached = self._cache.get(name)
+            if cached is None or cached[0] is not audience:
+                if self._entries is None:
+                    self._entries = model_entries(self._model)
+                combatants = audience.project(self._entries)
+                cached = (audience, Projection(
+                    version, combatants,
+                    dict(
+                        (combatant['name'], combatant)
+                        for combatant in combatants if 'name' in combatant
+                    ),
+                    json.dumps(combatants)
+                ))
+                self._cache[name] = cached
+            return cached[1]
+            
+## FUNCTIONS ###################################################################
+
+def combatant_fields(combatant):
+    """
+    Returns every field of a combatant, as plain values.
+    """
+    fields = {
+        'name': combatant.name,
+        'spd':  combatant.spd,
+        'dex':  combatant.dex,
+        'stun': {'cur': combatant.stun.cur, 'max': combatant.stun.max},
+        'body': {'cur': combatant.body.cur, 'max': combatant.body.max},
+        'end':  {'cur': combatant.end.cur, 'max': combatant.end.max},
+        'rec':  combatant.rec,
+        'seg': [
+            States.reverse_mapping[seg].lower()
+            for seg in combatant._segment
+        ],
+        'status': combatant.status,
+        'kind': combatant.kind,
+        'current': combatant.is_current
+    }
+    if isinstance(combatant, CombatantGroup):
+        fields['count'] = combatant.count
+    return fields
+    
+def model_entries(model):
+    """
+    Returns a ``(combatant, fields)`` pair for every combatant in the model.
+    """
+    # FIXME: shouldn't use _combatants, as it's kind of private.
+    return [
+        (combatant, combatant_fields(combatant))
+        for combatant in model._combatants
+    ]
+    
+def _fraction_left(char):
+    # Groups have one current value per member; go by their average.
+    cur = char['cur']
+    if isinstance(cur, list):
+        cur = float(sum(cur)) / len(cur) if cur else char['max']
+    return float(cur) / char['max'] if char['max'] > 0 else 1.0
+    
+def health(combatant, fields):
+    """
+    Describes how hurt a combatant is, without giving numbers away.
+    """
+    conditions = combatant.conditions
+    if "dying" in conditions:
+        return "dying"
+    if "unconscious" in conditions:
+        return "unconscious"
+    left = min(_fraction_left(fields['stun']), _fraction_left(fields['body']))
+    if left >= 1:
+        return "unhurt"
+    if left >= BADLY_WOUNDED:
+        return "wounded"
+    return "badly wounded"
+    
+# Fields worked out from the others, rather than shown as they are.
+DERIVED = {
+    'health': health,
+    'conditions': lambda combatant, fields: sorted(combatant.conditions)
+}
+
+def is_pc(combatant):
+    return combatant.kind == "PC"
+    
+def anyone(combatant):
+    return True
+    
+def gm():
+    return Audience(
+        "gm", [(anyone, ALL_FIELDS)], private=True,
+        description="everything, for the GM's own devices"
+    )
+    
+def players():
+    return Audience(
+        "players", [(is_pc, ALL_FIELDS), (anyone, GLIMPSE_FIELDS)],
+        description="PCs in full, and how hurt NPCs look"
+    )
+    
+def spectators():
+    return Audience(
+        "spectators", [(is_pc, SUMMARY_FIELDS), (anyone, GLIMPSE_FIELDS)],
+        description="how hurt everyone looks"
+    )
+    
+def pcs():
+    return Audience(
+        "pcs", [(is_pc, ALL_FIELDS)],
+        description="PCs alone, as served at /api/pcs"
+    )
+    
+def owner(name, pc_names):
+    """
+    Returns an audience for a player owning the PCs named ``pc_names``, who
+    sees those in full and everyone else as spectators do.
+    """
+    owned = frozenset(pc_names)
+    return Audience(
+        name, [
+            (lambda combatant: combatant.name in owned, ALL_FIELDS),
+            (is_pc, SUMMARY_FIELDS),
+            (anyone, GLIMPSE_FIELDS)
+        ],
+        description=", ".join(sorted(owned))
+    )
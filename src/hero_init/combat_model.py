@@ -26,9 +26,21 @@
 
 from _lib import enum
 import sys
+import array
+import fnmatch
+import itertools
 import contextlib
+from collections import namedtuple
 from PySide import QtCore, QtGui
 
+import tracing
+from event_log import EventLog
+from trie import PrefixTrie
+from events import (
+    EventBus, PhaseStarted, TurnEnded, CombatantAdded, CombatantRemoved,
+    DamageApplied, SpeedChanged, ConditionChanged
+)
+
 ## CLASSES #####################################################################
 
 COMBATANT_KINDS = [
@@ -74,7 +86,24 @@ SPEED_CHART = tuple(
     for speed in SPEED_CHART
 )
 
+# Conditions derived from characteristics, as (condition, characteristic,
+# test on its current value). A group has a condition once all of its
+# members do.
+CONDITIONS = (
+    ("unconscious", "stun", lambda cur: cur <= 0),
+    ("dying", "body", lambda cur: cur < 0),
+    ("exhausted", "end", lambda cur: cur <= 0),
+)
+CONDITION_NAMES = [condition for condition, _, _ in CONDITIONS]
+
+# One upcoming phase, as returned by SpeedChartModel.forecast. The post-12
+# recovery is listed as a phase in segment 0 with no combatant.
+Phase = namedtuple("Phase", "turn segment combatant")
+
 class Characteristic(object):
+    # Called with no arguments whenever cur changes, if set.
+    on_change = None
+    
     def __init__(self, current, maxval=None):
         if isinstance(current, str):
             parts = [s.strip() for s in current.split("/", 2)]
@@ -91,7 +120,9 @@ class Characteristic(object):
     @cur.setter
     def cur(self, newval):
         # Allow for negative cur, but not more than max.
-        self._cur = min(int(newval), self._max)         
+        self._cur = min(int(newval), self._max)
+        if self.on_change is not None:
+            self.on_change()
         
     @property
     def max(self):
@@ -103,8 +134,79 @@ class Characteristic(object):
     def __str__(self):
         return "{cur}/{max}".format(cur=self._cur, max=self._max)
 
+class GroupCharacteristic(object):
+    """
+    Characteristic shared by all members of a :class:`CombatantGroup`. The
+    maximum is common to the whole group, while the current value of each
+    member is kept in a compact integer array.
+    """
+    on_change = None
+    
+    def __init__(self, current, count, maxval=None):
+        proto = Characteristic(current, maxval)
+        self._max = proto.max
+        self._cur = array.array('i', [proto.cur]) * count
+        
+    def __len__(self):
+        return len(self._cur)
+        
+    def __getitem__(self, idx):
+        return MemberCharacteristic(self, idx)
+        
+    @property
+    def cur(self):
+        return list(self._cur)
+        
+    @property
+    def max(self):
+        return self._max
+        
+    def adjust(self, delta):
+        """
+        Adds ``delta`` to the current value of every member at once.
+        """
+        delta = int(delta)
+        maxval = self._max
+        for idx, cur in enumerate(self._cur):
+            self._cur[idx] = min(cur + delta, maxval)
+        if self.on_change is not None:
+            self.on_change()
+        
+    def __str__(self):
+        lo, hi = min(self._cur), max(self._cur)
+        if lo == hi:
+            return "{cur}/{max}".format(cur=lo, max=self._max)
+        return "{lo}-{hi}/{max}".format(lo=lo, hi=hi, max=self._max)
+        
+class MemberCharacteristic(Characteristic):
+    """
+    View onto the value of one member in a :class:`GroupCharacteristic`,
+    usable anywhere a :class:`Characteristic` is expected. The value lives
+    in the group's array, so :meth:`Characteristic.__init__` isn't used, and
+    the maximum, shared by the whole group, can't be set from a member.
+    """
+    def __init__(self, group_char, idx):
+        self._group_char = group_char
+        self._idx = idx
+        
+    @property
+    def cur(self):
+        return self._group_char._cur[self._idx]
+    @cur.setter
+    def cur(self, newval):
+        self._group_char._cur[self._idx] = min(int(newval), self._group_char._max)
+        if self._group_char.on_change is not None:
+            self._group_char.on_change()
+        
+    @property
+    def max(self):
+        return self._group_char._max
+        
+    def __str__(self):
+        return "{cur}/{max}".format(cur=self.cur, max=self.max)
+
 class Combatant(object):
-    def __init__(self, name, spd, dex, stun, body, end, status="", kind="PC"):
+    def __init__(self, name, spd, dex, stun, body, end, status="", kind="PC", rec=0):
         self._name = name
         self._spd = int(spd)
         self._dex = int(dex)
@@ -114,11 +216,51 @@ class Combatant(object):
         self._status = status
         self._segment = [None] * 12
         self._kind = kind
+        self._rec = int(rec)
+        
+        # Set to False to keep this combatant out of post-12 recovery.
+        self._recovers = True
         
         self._model = None     
         
+        self._conditions = set()
+        self._watch_characteristics()
+        
         self._next_turn()
         
+    def _watch_characteristics(self):
+        # Keeps conditions up to date as characteristics change.
+        for _, attr, _ in CONDITIONS:
+            getattr(self, attr).on_change = (
+                lambda attr=attr: self._update_conditions(attr)
+            )
+            self._update_conditions(attr)
+            
+    def _update_conditions(self, attr):
+        for condition, cond_attr, test in CONDITIONS:
+            if cond_attr != attr:
+                continue
+            cur = getattr(self, attr).cur
+            held = all(map(test, cur)) if isinstance(cur, list) else test(cur)
+            if held == (condition in self._conditions):
+                continue
+            if held:
+                self._conditions.add(condition)
+            else:
+                self._conditions.discard(condition)
+            if self._model is not None:
+                self._model._condition_changed(self, condition, held)
+        # How soon an unconscious combatant wakes depends on how far below
+        # zero their STUN is.
+        if attr == "stun" and "unconscious" in self._conditions:
+            self._wake_changed()
+            
+    def _wake_changed(self):
+        # Called whenever something that decides when this combatant wakes
+        # up changes, as the model's forecast may then be out of date.
+        if self._model is not None:
+            self._model._invalidate_forecast()
+        
     def _next_turn(self):
         self._segment = list(SPEED_CHART[self.spd])
         
@@ -149,6 +291,36 @@ class Combatant(object):
     @property
     def kind(self):
         return self._kind
+    @property
+    def rec(self):
+        return self._rec
+    @rec.setter
+    def rec(self, newval):
+        self._rec = int(newval)
+        self._wake_changed()
+    @property
+    def recovers(self):
+        return self._recovers
+    @recovers.setter
+    def recovers(self, newval):
+        self._recovers = bool(newval)
+        self._wake_changed()
+        
+    @property
+    def conditions(self):
+        """
+        Conditions (see :data:`CONDITIONS`) that currently hold for this
+        combatant.
+        """
+        return frozenset(self._conditions)
+        
+    @property
+    def display_name(self):
+        return self._name
+        
+    @property
+    def tooltip(self):
+        return None
         
     @property
     def is_current(self):
@@ -171,6 +343,13 @@ class Combatant(object):
         assert idx <= 12 and idx >= 1, idx
         self._segment[idx - 1] = state # Segments are 1-based!
         
+    def recover(self):
+        """
+        Takes a post-segment 12 recovery, regaining REC in STUN and END.
+        """
+        self._stun.cur += self._rec
+        self._end.cur += self._rec
+        
     def change_spd(self, newspd):
         # FIXME: doesn't handle NOW states properly.
         assert newspd >= 0 and newspd <= 12, newspd
@@ -178,6 +357,11 @@ class Combatant(object):
         self._spd = newspd
         newseg = list(SPEED_CHART[newspd])
         
+        if self._model is not None:
+            self._model._invalidate_forecast()
+            self._model.log_event("spd", self, old=old_spd, new=newspd)
+            self._model.events.emit(SpeedChanged, self, old_spd, newspd)
+        
         # As a special case, if the combatant is attached to a model
         # that is in the post-12 segment, the speed should change
         # immediately, without consulting the within-Turn rules.
@@ -205,7 +389,127 @@ class Combatant(object):
         # segments. Either way, newseg should be accurate.
         self._segment = newseg
 
+class CombatantGroup(Combatant):
+    """
+    A group of identical combatants (agents, minions, etc.) sharing a single
+    SPD, DEX and segment schedule. The group takes part in initiative as one
+    combatant, while each member keeps its own STUN, BODY and END. Members
+    are addressed as ``name#k``, with ``k`` counting from 1.
+    """
+    def __init__(self, name, count, spd, dex, stun, body, end, status="", kind="NPC", rec=0):
+        count = int(count)
+        if count < 1:
+            raise ValueError("A group must have at least one member.")
+        super(CombatantGroup, self).__init__(name, spd, dex, stun, body, end, status=status, kind=kind, rec=rec)
+        self._stun = GroupCharacteristic(stun, count)
+        self._body = GroupCharacteristic(body, count)
+        self._end = GroupCharacteristic(end, count)
+        self._watch_characteristics()
+        
+    @property
+    def count(self):
+        return len(self._stun)
+        
+    @property
+    def display_name(self):
+        return u"{name} ×{count}".format(name=self._name, count=self.count)
+        
+    @property
+    def tooltip(self):
+        return "\n".join(
+            "{name}: STUN {m.stun}, BODY {m.body}, END {m.end}".format(
+                name=m.name, m=m
+            )
+            for m in self.members()
+        )
+        
+    def recover(self):
+        # All members share the same REC, so recover them in one pass over
+        # each array.
+        self._stun.adjust(self._rec)
+        self._end.adjust(self._rec)
+        
+    def member(self, idx):
+        assert idx >= 1 and idx <= self.count, idx
+        return GroupMember(self, idx)
+        
+    def members(self):
+        for idx in xrange(1, self.count + 1):
+            yield GroupMember(self, idx)
+
+class GroupMember(object):
+    """
+    Lightweight handle on a single member of a :class:`CombatantGroup`.
+    Characteristics are views onto the group's arrays; everything else,
+    including the segment schedule, is shared with the group.
+    """
+    def __init__(self, group, idx):
+        self._group = group
+        self._idx = idx
+        
+    @property
+    def group(self):
+        return self._group
+    @property
+    def name(self):
+        return "{}#{}".format(self._group.name, self._idx)
+    @property
+    def stun(self):
+        return self._group._stun[self._idx - 1]
+    @property
+    def body(self):
+        return self._group._body[self._idx - 1]
+    @property
+    def end(self):
+        return self._group._end[self._idx - 1]
+        
+    # Members share everything else with the group, so changes to it are
+    # made to the group rather than to this short-lived handle.
+    @property
+    def status(self):
+        return self._group.status
+    @status.setter
+    def status(self, newval):
+        self._group.status = newval
+    @property
+    def rec(self):
+        return self._group.rec
+    @rec.setter
+    def rec(self, newval):
+        self._group.rec = newval
+    @property
+    def recovers(self):
+        return self._group.recovers
+    @recovers.setter
+    def recovers(self, newval):
+        self._group.recovers = newval
+        
+    def __getattr__(self, attr):
+        return getattr(self._group, attr)
+        
+    def __getitem__(self, idx):
+        return self._group[idx]
+        
+    def __setitem__(self, idx, state):
+        self._group[idx] = state
+        
+    # A new handle is made on each lookup, so handles on the same member
+    # compare equal.
+    def __eq__(self, other):
+        return isinstance(other, GroupMember) \
+            and (self._group, self._idx) == (other._group, other._idx)
+            
+    def __ne__(self, other):
+        return not self == other
+        
+    def __hash__(self):
+        return hash((self._group, self._idx))
+
 class SpeedChartProxyModel(QtGui.QSortFilterProxyModel):
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        with tracing.span("proxy sort", "qt"):
+            super(SpeedChartProxyModel, self).sort(column, order)
+            
     def lessThan(self, left, right):
         left_cmb = self.sourceModel()._combatants[left.row()]
         right_cmb = self.sourceModel()._combatants[right.row()]
@@ -218,7 +522,7 @@ class SpeedChartProxyModel(QtGui.QSortFilterProxyModel):
 class SpeedChartModel(QtCore.QAbstractTableModel):
     
     FORMATTERS = [
-        lambda C: C.name,
+        lambda C: C.display_name,
         lambda C: C.spd,
         lambda C: C.dex,
     ] + [
@@ -229,7 +533,7 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
         lambda C: str(C.stun),
         lambda C: str(C.body),
         lambda C: str(C.end),
-        lambda C: C.status,
+        lambda C: ", ".join(filter(None, [C.status] + sorted(C.conditions))),
     ]
     
     HEADER_NAMES = [
@@ -243,18 +547,55 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
     def __init__(self, parent=None):
         super(SpeedChartModel, self).__init__(parent)
         self._combatants = []
+        # Combatants by name, for resolving and completing name prefixes.
+        self._names = PrefixTrie()
+        # Sets of combatants by kind and by condition, kept up to date as
+        # combatants come and go and as their conditions change.
+        self._kinds = {kind: set() for kind in COMBATANT_KINDS}
+        self._conditions = {condition: set() for condition in CONDITION_NAMES}
+        # Increasing number for each combatant, in roster order, so that
+        # matches found through the indexes can be put back in that order.
+        self._positions = {}
+        self._next_position = itertools.count()
+        
+        # Whether next() passes over the phases of unconscious combatants.
+        self.skip_unconscious = True
         
         self._now = (1, 1)
         self._current_combatant = None
         
         self.on_post12 = None
         
+        self._batch_depth = 0
+        self._version = 0
+        
+        # Formatted cells by (combatant, column), shared by every view of
+        # this model, and the version they were formatted at.
+        self._cells = {}
+        self._cells_version = 0
+        
+        # Cached result of forecast(), and a counter bumped whenever it is
+        # invalidated, so that a forecast computed from a server thread
+        # during a change is never cached.
+        self._forecast = None
+        self._forecast_generation = 0
+        
+        self.log = EventLog()
+        self.events = EventBus()
+        
     ## PROPERTIES ##############################################################
         
     @property
     def n_combatants(self):
         return len(self._combatants)
         
+    @property
+    def names(self):
+        """
+        :class:`PrefixTrie` of the combatants by name. Read-only.
+        """
+        return self._names
+        
     @property
     def turn(self):
         return self._now[0]
@@ -267,6 +608,14 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
     def current_combatant(self):
         return self._current_combatant
         
+    @property
+    def version(self):
+        """
+        Counter incremented each time listeners are told that the model has
+        changed.
+        """
+        return self._version
+        
     ## QT MODEL CONTRACT #######################################################    
     
     def rowCount(self, parent=None):
@@ -283,7 +632,9 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
             return None
             
         if role == QtCore.Qt.DisplayRole:
-            return self.FORMATTERS[index.column()](self._combatants[index.row()])
+            return self.cell(self._combatants[index.row()], index.column())
+        elif role == QtCore.Qt.ToolTipRole:
+            return self._combatants[index.row()].tooltip
         
         return None
         
@@ -296,15 +647,138 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
         
         return None
         
+    def beginResetModel(self):
+        # Inside of a batch, resets are folded into the batch's own reset.
+        if self._batch_depth == 0:
+            super(SpeedChartModel, self).beginResetModel()
+            
+    def endResetModel(self):
+        if self._batch_depth == 0:
+            self._version += 1
+            # Views, and the proxy model sorting for them, catch up here.
+            with tracing.span("model reset", "qt"):
+                super(SpeedChartModel, self).endResetModel()
+        
     ## PRIVATE METHODS #########################################################
     
+    def _index(self, combatant):
+        self._positions[combatant] = next(self._next_position)
+        self._names.add(combatant.name, combatant)
+        self._kinds.setdefault(combatant.kind, set()).add(combatant)
+        for condition in combatant.conditions:
+            self._conditions[condition].add(combatant)
+            
+    def _unindex(self, combatant):
+        del self._positions[combatant]
+        self._names.remove(combatant.name, combatant)
+        self._kinds[combatant.kind].discard(combatant)
+        for condition in combatant.conditions:
+            self._conditions[condition].discard(combatant)
+            
+    def _condition_changed(self, combatant, condition, held):
+        # Called by combatants whenever one of their conditions changes.
+        if held:
+            self._conditions[condition].add(combatant)
+        else:
+            self._conditions[condition].discard(combatant)
+        if condition == "unconscious":
+            self._invalidate_forecast()
+        self.log_event("condition", combatant, condition=condition, held=held)
+        self.events.emit(ConditionChanged, combatant, condition, held)
+        
+    def _recoveries_to_wake(self, combatant):
+        # Number of post-12 recoveries after which an unconscious combatant
+        # will be conscious again, assuming nothing else happens, or None if
+        # recovery will never wake them.
+        if combatant not in self._conditions["unconscious"]:
+            return 0
+        rec = combatant.rec if combatant.recovers else 0
+        if rec <= 0 or combatant.stun.max <= 0:
+            return None
+        # A group wakes up with its first member.
+        stun = combatant.stun.cur
+        highest = max(stun) if isinstance(stun, list) else stun
+        return (-highest) // rec + 1
+        
+    def _invalidate_forecast(self):
+        self._forecast = None
+        self._forecast_generation += 1
+        
+    def _iter_phases(self):
+        # Yields upcoming phases in the order that next() will reach them,
+        # without changing any state.
+        turn, seg = self._now
+        
+        # next() takes the first of the highest DEX combatants, which is the
+        # order given by a stable sort on DEX.
+        order = sorted(self._combatants, key=lambda cmb: -cmb.dex)
+        
+        # Unconscious combatants lose their phases until enough post-12
+        # recoveries have woken them up.
+        if self.skip_unconscious:
+            wakes = {
+                cmb: self._recoveries_to_wake(cmb)
+                for cmb in self._conditions["unconscious"]
+            }
+        else:
+            wakes = {}
+        def acts(cmb, recoveries):
+            wake = wakes.get(cmb, 0)
+            return wake is not None and recoveries >= wake
+        
+        # Rest of the current Turn, read from the segment states. ABORTed
+        # phases are skipped by next(), so only FUTURE phases are listed.
+        for idx_seg in xrange(max(seg, 1), 13):
+            for cmb in order:
+                if cmb[idx_seg] == States.FUTURE and acts(cmb, 0):
+                    yield Phase(turn, idx_seg, cmb)
+                    
+        # Later Turns start from the SPD chart, each preceded by the post-12
+        # recovery that ends the Turn before it.
+        turn += 1
+        recoveries = 1
+        while True:
+            yield Phase(turn, 0, None)
+            for idx_seg in xrange(1, 13):
+                for cmb in order:
+                    if SPEED_CHART[cmb.spd][idx_seg - 1] == States.FUTURE \
+                            and acts(cmb, recoveries):
+                        yield Phase(turn, idx_seg, cmb)
+            turn += 1
+            recoveries += 1
+    
+    def _skip_unconscious(self, cmbs):
+        # Passes over the phases of unconscious combatants in the current
+        # segment, returning the combatants left to act.
+        unconscious = self._conditions["unconscious"]
+        if not unconscious:
+            return cmbs
+        acting = []
+        for cmb in cmbs:
+            if cmb in unconscious:
+                cmb[self.segment] = States.PAST
+                self.log_event("skip", cmb)
+            else:
+                acting.append(cmb)
+        return acting
+        
+    @tracing.traced("recover", "model")
+    def _recover(self):
+        # Built-in post-segment 12 recovery, done in a single pass over the
+        # roster.
+        for combatant in self._combatants:
+            if combatant.recovers and combatant.rec != 0:
+                combatant.recover()
+    
     def _increment(self):
         turn, seg = self._now
         if seg == 12:
             self._now = (turn + 1, 0)
+            self._recover()
             if self.on_post12 is not None:
                 try:
-                    self.on_post12()
+                    with tracing.span("post12 script", "script"):
+                        self.on_post12()
                 except Exception as ex:
                     print "Error during post-12 script:"
                     print ex
@@ -317,6 +791,41 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
         
     ## PUBLIC METHODS ##########################################################
     
+    def log_event(self, kind, combatant=None, public=None, **details):
+        """
+        Appends an entry to the event log, stamped with the current turn and
+        segment and the name of the combatant concerned, if any. Entries are
+        public (shown to players) if they concern a PC or no combatant at
+        all, unless ``public`` says otherwise.
+        """
+        if public is None:
+            public = combatant is None or combatant.kind == "PC"
+        return self.log.append(
+            kind,
+            turn=self.turn, segment=self.segment,
+            name=combatant.name if combatant is not None else None,
+            public=public,
+            **details
+        )
+    
+    def forecast(self, n_phases=10):
+        """
+        Returns the next ``n_phases`` phases as a list of :class:`Phase`
+        tuples, in the order in which they will come up, crossing segment
+        and Turn boundaries. Post-segment 12 is listed as a phase with no
+        combatant.
+        
+        The forecast is cached until the turn order changes.
+        """
+        forecast = self._forecast
+        if forecast is None or len(forecast) < n_phases:
+            generation = self._forecast_generation
+            forecast = list(itertools.islice(self._iter_phases(), n_phases))
+            if generation == self._forecast_generation:
+                self._forecast = forecast
+        return forecast[:n_phases]
+    
+    @tracing.traced("add", "model")
     def add_combatant(self, combatant):
         # Attach the current combatant to this model.
         combatant._model = self
@@ -324,31 +833,83 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
         # FIXME: doesn't check for duplicates!
         self.beginResetModel()
         self._combatants.append(combatant)
+        self._index(combatant)
+        self._invalidate_forecast()
+        self.log_event("add", combatant)
+        self.events.emit(CombatantAdded, combatant)
         self.endResetModel()
         
+    @tracing.traced("add many", "model")
+    def add_combatants(self, combatants):
+        """
+        Adds many combatants at once, notifying views with a single row
+        insertion.
+        """
+        combatants = list(combatants)
+        if not combatants:
+            return
+        for combatant in combatants:
+            combatant._model = self
+            
+        first = len(self._combatants)
+        if self._batch_depth == 0:
+            self.beginInsertRows(QtCore.QModelIndex(), first, first + len(combatants) - 1)
+        self._combatants.extend(combatants)
+        for combatant in combatants:
+            self._index(combatant)
+        self._invalidate_forecast()
+        self.log_event("add", public=False, count=len(combatants))
+        if self.events.wants(CombatantAdded):
+            with self.events.hold():
+                for combatant in combatants:
+                    self.events.emit(CombatantAdded, combatant)
+        if self._batch_depth == 0:
+            self._version += 1
+            with tracing.span("rows inserted", "qt"):
+                self.endInsertRows()
+        
+    @tracing.traced("del", "model")
     def del_combatant(self, name):
-        self.get_combatant(name)._model = None
+        cmb = self.get_combatant(name)
+        if cmb is None:
+            raise RuntimeError("No such combatant {}.".format(name))
+        if isinstance(cmb, GroupMember):
+            raise RuntimeError("Can't remove one member of {}.".format(cmb.group.name))
+        cmb._model = None
         
         self.beginResetModel()
-        self._combatants.remove(self.get_combatant(name))
+        self._combatants.remove(cmb)
+        self._unindex(cmb)
+        self._invalidate_forecast()
+        self.log_event("del", cmb)
+        self.events.emit(CombatantRemoved, cmb)
         self.endResetModel()
     
     def get_combatant(self, key):
-        # FIXME: slow as fuck.
         # Start by looking for an exact match.
-        for combatant in self._combatants:
-            if combatant.name == key:
-                return combatant
+        exact = self._names.get(key)
+        if exact:
+            return exact[0]
                 
-        # If none was found, count how many start with the key.
-        # If that's exactly one, return it.
-        matches = [c for c in self._combatants if c.name.startswith(key)]
-        if len(matches) == 1:
-            return matches[0]
+        # Keys of the form "name#k" refer to the kth member of a group.
+        if "#" in key:
+            group_key, _, idx = key.rpartition("#")
+            group = self.get_combatant(group_key)
+            if isinstance(group, CombatantGroup) and idx.isdigit():
+                idx = int(idx)
+                if 1 <= idx <= group.count:
+                    return group.member(idx)
+            return None
+                
+        # If none was found, check whether exactly one name starts with
+        # the key, and if so, return it.
+        if self._names.count(key) == 1:
+            return self._names.values(key)[0]
             
         # We didn't find anything, so return None.
         return None
                 
+    @tracing.traced("abort", "model")
     def abort_phase(self, key):
         # TODO: specialize exceptions.
         # Check for two conditions:
@@ -378,15 +939,154 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
         idx_seg = iter(idx + 1 for idx, seg in enumerate(cmb._segment) if seg == States.FUTURE).next()
         with self.modify_combatant(key):
             cmb[idx_seg] = States.ABORT
+            self._invalidate_forecast()
+            self.log_event("abort", cmb, phase=idx_seg)
+            
+    def cell(self, combatant, column):
+        """
+        Returns the text shown for one combatant in one column. Cells are
+        formatted once per version of the model, however many views show
+        them.
+        """
+        if self._cells_version != self._version:
+            self._cells = {}
+            self._cells_version = self._version
+        key = (combatant, column)
+        try:
+            return self._cells[key]
+        except KeyError:
+            text = self._cells[key] = self.FORMATTERS[column](combatant)
+            return text
+        
+    def with_condition(self, condition):
+        """
+        Returns the set of combatants for which a condition (see
+        :data:`CONDITIONS`) currently holds.
+        """
+        return frozenset(self._conditions[condition])
+        
+    def of_kind(self, kind):
+        """
+        Returns the set of combatants of a given kind (``"PC"`` or ``"NPC"``),
+        so that, for instance, the conscious NPCs are
+        ``model.of_kind("NPC") - model.with_condition("unconscious")``.
+        """
+        return frozenset(self._kinds.get(kind, ()))
+        
+    def find_combatants(self, patterns):
+        """
+        Returns the combatants matched by any of the given patterns, in the
+        order of the patterns and then of the roster, each at most once. A
+        pattern is a name or unique prefix, as for :meth:`get_combatant`, a
+        glob such as ``"Agent*"``, or ``"@PC"``/``"@NPC"`` for every combatant
+        of that kind. Raises :class:`RuntimeError` if a pattern matches
+        nobody.
+        """
+        found = [None] * len(patterns)
+        scanned = []
+        for idx, pattern in enumerate(patterns):
+            if pattern.startswith("@"):
+                found[idx] = sorted(self.of_kind(pattern[1:]), key=self._positions.get)
+            elif any(char in pattern[:-1] for char in "*?["):
+                scanned.append((idx, lambda cmb, glob=pattern: fnmatch.fnmatchcase(cmb.name, glob)))
+            elif pattern.endswith("*"):
+                # Globs that are just a prefix are answered by the name index.
+                found[idx] = sorted(
+                    self._names.values(pattern[:-1]), key=self._positions.get
+                )
+            else:
+                cmb = self.get_combatant(pattern)
+                found[idx] = [cmb] if cmb is not None else []
+                
+        # Other globs are matched in a single pass over the roster.
+        if scanned:
+            for idx, _ in scanned:
+                found[idx] = []
+            for cmb in self._combatants:
+                for idx, matches in scanned:
+                    if matches(cmb):
+                        found[idx].append(cmb)
+                        
+        combatants = []
+        seen = set()
+        for pattern, matches in zip(patterns, found):
+            if not matches:
+                raise RuntimeError("No such combatant {}.".format(pattern))
+            for cmb in matches:
+                if cmb not in seen:
+                    seen.add(cmb)
+                    combatants.append(cmb)
+        return combatants
+        
+    @tracing.traced("damage", "model")
+    def apply_damage(self, key, amounts, falloff=0):
+        """
+        Applies damage to one or more characteristics of a combatant as a
+        single modification. ``amounts`` maps ``"stun"``, ``"body"`` and
+        ``"end"`` to the damage taken; negative amounts heal. Naming a group
+        damages every one of its members.
+        
+        ``key`` may also be a list of patterns, as for
+        :meth:`find_combatants`, in which case every target is damaged in a
+        single modification. With a ``falloff``, each target after the first
+        takes that much less of each amount than the one before it, down to
+        nothing.
+        """
+        if isinstance(key, basestring):
+            cmb = self.get_combatant(key)
+            if cmb is None:
+                raise RuntimeError("No such combatant.")
+            targets = [cmb]
+        else:
+            targets = self.find_combatants(key)
+            
+        with self.batch():
+            for idx, cmb in enumerate(targets):
+                taken = {
+                    attr: cmp(amt, 0) * max(abs(amt) - idx * falloff, 0)
+                    for attr, amt in amounts.iteritems()
+                }
+                for attr, amt in taken.iteritems():
+                    if isinstance(cmb, CombatantGroup):
+                        getattr(cmb, attr).adjust(-amt)
+                    else:
+                        getattr(cmb, attr).cur -= amt
+                self.log_event("damage", cmb, **taken)
+                self.events.emit(DamageApplied, cmb, taken)
+            
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups every change made within the context into a single model
+        reset, so that views and other listeners are notified only once.
+        Events on :attr:`events` are held until the batch ends. Batches may
+        be nested.
+        """
+        if self._batch_depth == 0:
+            super(SpeedChartModel, self).beginResetModel()
+        self._batch_depth += 1
+        try:
+            with self.events.hold():
+                yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._version += 1
+                with tracing.span("model reset", "qt"):
+                    super(SpeedChartModel, self).endResetModel()
             
     @contextlib.contextmanager
     def modify_combatant(self, key):
         self.beginResetModel() # ← I really shouldn't do this.
-        yield self.get_combatant(key)
-        self.endResetModel()
+        try:
+            yield self.get_combatant(key)
+        finally:
+            self.endResetModel()
         
+    @tracing.traced("next", "model")
     def next(self):
         self.beginResetModel() # This is really lazy...
+        self._invalidate_forecast()
     
         # Remove the current combatant's turn.
         if self._current_combatant is not None and self.segment is not None:
@@ -401,6 +1101,8 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
             # TODO: move this out into its own method.
             if self.segment > 0:
                 cmbs_this_seg = [cmb for cmb in self._combatants if cmb[self.segment] in (States.FUTURE, States.ABORT)]
+                if self.skip_unconscious:
+                    cmbs_this_seg = self._skip_unconscious(cmbs_this_seg)
             else:
                 cmbs_this_seg = False
                 
@@ -413,6 +1115,8 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
                 # "post-12" state, with no current combatant.
                 if self._increment():
                     self._current_combatant = None
+                    self.log_event("post12")
+                    self.events.emit(TurnEnded, self.turn - 1)
                     self.endResetModel()
                     return
             
@@ -426,10 +1130,62 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
         else:
             # If we didn't pass by the character, then they move to NOW.
             next_cmb[self.segment] = States.NOW
+            self.log_event("phase", next_cmb)
+            self.events.emit(PhaseStarted, self.turn, self.segment, next_cmb)
         
         # Notify that the data has changed.
         self.endResetModel()
 
+    @tracing.traced("advance", "model")
+    def advance(self, turns=1, until=None):
+        """
+        Fast-forwards through the rest of this Turn and ``turns - 1`` more,
+        stopping in the post-segment 12 that ends the last of them, just as
+        calling :meth:`next` until then would, but without taking each phase
+        in turn. Post-12 recoveries and the ``on_post12`` hook still run for
+        every Turn, and views are notified once at the end.
+        
+        If given, ``until`` is called with the model after each post-12, and
+        stops the advance as soon as it returns ``True``. Returns the number
+        of Turns advanced.
+        """
+        advanced = 0
+        if turns < 1:
+            return advanced
+        with self.batch():
+            self._invalidate_forecast()
+            
+            # Every phase left in this Turn passes without anyone acting.
+            for cmb in self._combatants:
+                for idx_seg in xrange(max(self.segment, 1), 13):
+                    if cmb[idx_seg] in (States.FUTURE, States.ABORT, States.NOW):
+                        cmb[idx_seg] = States.PAST
+            self._current_combatant = None
+            
+            while advanced < turns:
+                self._now = (self.turn, 12)
+                self._increment()
+                advanced += 1
+                if until is not None and until(self):
+                    break
+                    
+            self.log_event("advance", turns=advanced)
+            if advanced:
+                self.events.emit(TurnEnded, self.turn - 1)
+        return advanced
+        
+    def advance_until(self, until, max_turns=1000):
+        """
+        Advances Turn by Turn, as :meth:`advance` does, until ``until`` returns
+        ``True`` for the model, giving up after ``max_turns``. Returns the
+        number of Turns advanced, or ``None`` if ``until`` never held.
+        """
+        if until(self):
+            return 0
+        advanced = self.advance(max_turns, until=until)
+        return advanced if until(self) else None
+            
+    @tracing.traced("skip to", "model")
     def skip_to(self, seg):
         if seg > 12 or seg < 1:
             raise ValueError("Invalid segment.")
@@ -438,6 +1194,8 @@ class SpeedChartModel(QtCore.QAbstractTableModel):
             raise ValueError("Cannot skip to the past.")
             
         # Erase the past from the new segment.
+        self._invalidate_forecast()
+        self.log_event("skipto", to=seg)
         self._now = (self.turn, seg)
         for cmb in self._combatants:
             for idx_past_seg in xrange(1, seg):
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# dice.py: Rolling HERO System normal and killing damage.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import re
+import random
+
+# NumPy is optional; without it, dice are rolled one at a time.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+## CONSTANTS ###################################################################
+
+DAMAGE_KINDS = {
+    "N": "normal",
+    "K": "killing"
+}
+
+# Matches "12d6", "2.5d6" and "2½d6".
+DICE_RE = re.compile(r"^(\d+)(\.5|½)?d6$", re.IGNORECASE)
+
+## CLASSES #####################################################################
+
+class DamageRoll(object):
+    """
+    STUN and BODY rolled for one or more hits of the same attack.
+    """
+    def __init__(self, spec, kind, stun, body):
+        self.spec = spec
+        self.kind = kind
+        self.stun = [int(x) for x in stun]
+        self.body = [int(x) for x in body]
+        
+    @property
+    def hits(self):
+        return len(self.stun)
+        
+    @property
+    def total_stun(self):
+        return sum(self.stun)
+        
+    @property
+    def total_body(self):
+        return sum(self.body)
+        
+    def __str__(self):
+        desc = "{} {}: ".format(self.spec, self.kind)
+        if self.hits > 1:
+            desc += ", ".join(
+                "{}/{}".format(stun, body)
+                for stun, body in zip(self.stun, self.body)
+            ) + " (total "
+        desc += "{} STUN, {} BODY".format(self.total_stun, self.total_body)
+        if self.hits > 1:
+            desc += ")"
+        return desc
+
+## FUNCTIONS ###################################################################
+
+def seed(value):
+    """
+    Seeds the dice, so that the same sequence of rolls can be made again
+    (for instance, when replaying a recorded session).
+    """
+    random.seed(value)
+    if np is not None:
+        np.random.seed(value)
+
+def parse_dice(spec):
+    """
+    Parses a dice specification such as ``"12d6"`` or ``"2½d6"`` into the
+    number of whole dice and whether there is an extra half die.
+    """
+    match = DICE_RE.match(spec.strip())
+    if match is None:
+        raise ValueError("Dice must be given as <n>d6 or <n>.5d6, not {}.".format(spec))
+    return int(match.group(1)), match.group(2) is not None
+
+def roll_damage(spec, kind="N", hits=1):
+    """
+    Rolls ``hits`` hits of the attack described by ``spec`` (see
+    :func:`parse_dice`), returning a :class:`DamageRoll`.
+    
+    For normal damage (``kind == "N"``), STUN is the total of the dice and
+    each die counts 0 BODY on a 1, 2 BODY on a 6 and 1 BODY otherwise. For
+    killing damage (``kind == "K"``), BODY is the total of the dice and STUN
+    is the BODY times a multiplier of 1d6-1 (at least 1) rolled per hit. A
+    half die counts half its roll, rounded up, toward a total, and 1 BODY on
+    a 4 or more for normal damage.
+    
+    All dice for all hits are drawn together.
+    """
+    kind = kind.upper()
+    if kind not in DAMAGE_KINDS:
+        raise ValueError("Damage kind must be one of {}, not {}.".format(
+            ", ".join(sorted(DAMAGE_KINDS)), kind
+        ))
+    n_dice, half = parse_dice(spec)
+    hits = int(hits)
+    if hits < 1:
+        raise ValueError("There must be at least one hit.")
+        
+    roll = _roll_numpy if np is not None else _roll_python
+    stun, body = roll(n_dice, half, kind, hits)
+    return DamageRoll(spec, DAMAGE_KINDS[kind], stun, body)
+    
+def _roll_numpy(n_dice, half, kind, hits):
+    # One column per whole die, then the half die and the STUN multiplier.
+    dice = np.random.randint(1, 7, size=(hits, n_dice + 2))
+    whole, half_die, mult = dice[:, :n_dice], dice[:, n_dice], dice[:, n_dice + 1]
+    half_total = (half_die + 1) // 2 if half else 0
+    
+    if kind == "N":
+        stun = whole.sum(axis=1) + half_total
+        body = (whole > 1).sum(axis=1) + (whole == 6).sum(axis=1)
+        if half:
+            body += half_die >= 4
+    else:
+        body = whole.sum(axis=1) + half_total
+        stun = body * np.maximum(mult - 1, 1)
+    return stun, body
+    
+def _roll_python(n_dice, half, kind, hits):
+    stun, body = [], []
+    for idx_hit in xrange(hits):
+        whole = [random.randint(1, 6) for idx_die in xrange(n_dice)]
+        half_die = random.randint(1, 6) if half else 0
+        half_total = (half_die + 1) // 2
+        
+        if kind == "N":
+            stun.append(sum(whole) + half_total)
+            body.append(
+                sum(0 if die == 1 else 2 if die == 6 else 1 for die in whole) +
+                (1 if half_die >= 4 else 0)
+            )
+        else:
+            hit_body = sum(whole) + half_total
+            body.append(hit_body)
+            stun.append(hit_body * max(random.randint(1, 6) - 1, 1))
+    return stun, body
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# event_log.py: Bounded log of what happened during a combat.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import time
+
+## CLASSES #####################################################################
+
+class EventLog(object):
+    """
+    Fixed-capacity ring buffer of log entries. Each entry is a dictionary
+    with a sequence number (``'seq'``), starting at 1 and increasing by one
+    per entry, so that readers can ask for everything after the last entry
+    they saw. Once the log is full, each new entry replaces the oldest one.
+    
+    Entries are appended from the Qt thread and may be read from server
+    threads; readers simply skip any slot overwritten while they read it.
+    """
+    
+    def __init__(self, capacity=1000):
+        self._capacity = int(capacity)
+        self._entries = [None] * self._capacity
+        self._next_seq = 1
+        
+    def __len__(self):
+        return min(self._next_seq - 1, self._capacity)
+        
+    @property
+    def capacity(self):
+        return self._capacity
+        
+    @property
+    def last_seq(self):
+        """
+        Sequence number of the latest entry, or 0 if the log is empty.
+        """
+        return self._next_seq - 1
+        
+    @property
+    def first_seq(self):
+        """
+        Sequence number of the oldest entry still held.
+        """
+        return max(1, self._next_seq - self._capacity)
+        
+    def append(self, kind, **details):
+        """
+        Adds an entry of the given kind, with any other fields given as
+        keyword arguments, and returns its sequence number.
+        """
+        seq = self._next_seq
+        entry = dict(details, seq=seq, kind=kind, time=time.time())
+        self._entries[seq % self._capacity] = entry
+        self._next_seq = seq + 1
+        return seq
+        
+    def since(self, seq=0, limit=100):
+        """
+        Returns up to ``limit`` entries with sequence numbers after ``seq``,
+        oldest first. Entries that have already been dropped from the log
+        are silently skipped.
+        """
+        next_seq = self._next_seq
+        start = max(seq + 1, next_seq - self._capacity, 1)
+        stop = min(start + max(limit, 0), next_seq)
+        entries = []
+        for idx_seq in xrange(start, stop):
+            entry = self._entries[idx_seq % self._capacity]
+            if entry is not None and entry['seq'] == idx_seq:
+                entries.append(entry)
+        return entries
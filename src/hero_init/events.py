@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# events.py: Typed change notifications for non-Qt consumers of the model.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import sys
+import traceback
+import contextlib
+from collections import namedtuple
+
+## EVENTS ######################################################################
+
+# Events are plain tuples. Those that can be merged during a batch define a
+# coalesce_key, and a merge method combining an earlier event with a later
+# one of the same key.
+
+class PhaseStarted(namedtuple("PhaseStarted", "turn segment combatant")):
+    __slots__ = ()
+    coalesce_key = None
+    
+class TurnEnded(namedtuple("TurnEnded", "turn")):
+    __slots__ = ()
+    coalesce_key = None
+    
+class CombatantAdded(namedtuple("CombatantAdded", "combatant")):
+    __slots__ = ()
+    coalesce_key = None
+    
+class CombatantRemoved(namedtuple("CombatantRemoved", "combatant")):
+    __slots__ = ()
+    coalesce_key = None
+    
+class DamageApplied(namedtuple("DamageApplied", "combatant amounts")):
+    __slots__ = ()
+    @property
+    def coalesce_key(self):
+        return (DamageApplied, id(self.combatant))
+        
+    def merge(self, later):
+        amounts = dict(self.amounts)
+        for attr, amt in later.amounts.iteritems():
+            amounts[attr] = amounts.get(attr, 0) + amt
+        return DamageApplied(self.combatant, amounts)
+    
+class SpeedChanged(namedtuple("SpeedChanged", "combatant old new")):
+    __slots__ = ()
+    @property
+    def coalesce_key(self):
+        return (SpeedChanged, id(self.combatant))
+        
+    def merge(self, later):
+        return SpeedChanged(self.combatant, self.old, later.new)
+        
+class ConditionChanged(namedtuple("ConditionChanged", "combatant condition held")):
+    __slots__ = ()
+    @property
+    def coalesce_key(self):
+        return (ConditionChanged, id(self.combatant), self.condition)
+        
+    def merge(self, later):
+        return later
+        
+## CLASSES #####################################################################
+
+class EventBus(object):
+    """
+    In-process observer bus. Handlers subscribe to one event type at a time,
+    and are called with each event of that type.
+    
+    Events are emitted by passing the event type and its fields to
+    :meth:`emit`; the event itself is only built if someone is subscribed,
+    so that emitting costs next to nothing otherwise.
+    
+    While the bus is held (see :meth:`hold`), events are queued rather than
+    delivered. When the outermost hold ends, events that refer to the same
+    thing (for instance, damage to the same combatant) are merged, and the
+    rest are delivered in order.
+    """
+    
+    def __init__(self):
+        self._handlers = {}
+        self._hold_depth = 0
+        self._queue = []
+        
+    def subscribe(self, event_type, handler):
+        self._handlers.setdefault(event_type, []).append(handler)
+        
+    def unsubscribe(self, event_type, handler):
+        handlers = self._handlers.get(event_type, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self._handlers.pop(event_type, None)
+            
+    def wants(self, event_type):
+        return event_type in self._handlers
+        
+    def emit(self, event_type, *fields):
+        if event_type not in self._handlers:
+            return
+        event = event_type(*fields)
+        if self._hold_depth > 0:
+            self._queue.append(event)
+        else:
+            self._deliver(event)
+            
+    @contextlib.contextmanager
+    def hold(self):
+        self._hold_depth += 1
+        try:
+            yield self
+        finally:
+            self._hold_depth -= 1
+            if self._hold_depth == 0 and self._queue:
+                queue, self._queue = self._queue, []
+                for event in self._coalesce(queue):
+                    self._deliver(event)
+                    
+    def _coalesce(self, queue):
+        merged = []
+        positions = {}
+        for event in queue:
+            key = event.coalesce_key
+            if key is None:
+                merged.append(event)
+            elif key in positions:
+                idx = positions[key]
+                merged[idx] = merged[idx].merge(event)
+            else:
+                positions[key] = len(merged)
+                merged.append(event)
+        return merged
+        
+    def _deliver(self, event):
+        # Copy the handler list, so that handlers may unsubscribe themselves.
+        for handler in list(self._handlers.get(type(event), ())):
+            try:
+                handler(event)
+            except Exception:
+                print >>sys.stderr, "Error in handler for {}:".format(type(event).__name__)
+                traceback.print_exc()
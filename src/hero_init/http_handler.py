@@ -24,38 +24,32 @@
 
 ## IMPORTS #####################################################################
 
-import os
+import hmac
 import json
-import mimetypes
 import urllib2
+import urlparse
+import time
+import Queue
+import select
+import socket
+import threading
+import SocketServer
 import SimpleHTTPServer
-import zipfile
-from contextlib import contextmanager
+from collections import OrderedDict
 
+import tracing
+from static_bundle import static_files
 from combat_model import *
+from audiences import Audiences, Projections, combatant_fields, model_entries, pcs
 
 ## CLASSES #####################################################################
 
 class HeroEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Combatant):
-            return {
-                'name': obj.name,
-                'spd':  obj.spd,
-                'dex':  obj.dex,
-                'stun': obj.stun,
-                'body': obj.body,
-                'end':  obj.end,
-                'seg': [
-                    States.reverse_mapping[seg].lower()
-                    for seg in obj._segment
-                ], # TODO: use reverse_mapping on segments.
-                'status': obj.status,
-                'kind': obj.kind,
-                'current': obj.is_current
-            }
+            return combatant_fields(obj)
             
-        elif isinstance(obj, Characteristic):
+        elif isinstance(obj, (Characteristic, GroupCharacteristic)):
             return {
                 'cur': obj.cur,
                 'max': obj.max
@@ -64,91 +58,565 @@ class HeroEncoder(json.JSONEncoder):
         else:
             return super(HeroEncoder, self).default(obj)    
 
-# Load resources from hero_init._static.
-this_dir, this_fname = os.path.split(__file__)
-if 'hero_init.app' in this_dir:
-    dir_parts = this_dir.partition('hero_init.app')
-    static_dir = dir_parts[0] + dir_parts[1] + \
-        '/Contents/Resources/hero_init/_static'
-else:
-    static_dir = os.path.join(this_dir, "_static")
+class PCDeltas(object):
+    """
+    Remembers the PCs as served at the last few model versions, so that a
+    client can ask only for what changed since the version it already has.
+    
+    Every version that a client can know about has been served, and thus
+    remembered, so a client only falls back to a full snapshot if it is
+    further behind than ``depth`` versions.
+    """
+    def __init__(self, depth=64):
+        self._depth = depth
+        self._history = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def payload(self, version, load_pcs, since=None):
+        """
+        Returns the response for a client at version ``since``: either a
+        full snapshot (``'full': True`` with the list of ``'pcs'``) or, for
+        each PC that changed, only its changed fields (``'changes'``),
+        along with the names of PCs that are gone (``'removed'``).
+        ``load_pcs`` is called to get the list of PC dictionaries if
+        ``version`` hasn't been seen yet.
+        """
+        with self._lock:
+            if version not in self._history:
+                pcs = load_pcs()
+                self._history[version] = (pcs, dict((pc['name'], pc) for pc in pcs))
+                while len(self._history) > self._depth:
+                    self._history.popitem(last=False)
+            pcs, by_name = self._history[version]
+            old = self._history.get(since)
+            
+        if old is None:
+            return {'version': version, 'full': True, 'pcs': pcs}
+            
+        old_by_name = old[1]
+        changes = {}
+        for name, pc in by_name.iteritems():
+            prev = old_by_name.get(name)
+            if prev is None:
+                changes[name] = pc
+            else:
+                diff = dict(
+                    (field, value) for field, value in pc.iteritems()
+                    if prev.get(field) != value
+                )
+                if diff:
+                    changes[name] = diff
+        return {
+            'version': version,
+            'full': False,
+            'changes': changes,
+            'removed': [name for name in old_by_name if name not in by_name]
+        }
+
+class PooledHTTPServer(SocketServer.TCPServer):
+    """
+    TCP server handing accepted connections to a fixed pool of worker
+    threads through a bounded queue, rather than starting a thread per
+    connection. Connections arriving while the queue is full are closed
+    straight away.
+    
+    Between requests, persistent connections don't hold on to a worker.
+    Handlers :meth:`park` them instead, and a single thread waits on all
+    parked connections at once, queueing each for a worker again once its
+    next request comes in, or closing it once it has been idle for
+    ``IDLE_TIMEOUT`` seconds.
+    """
+    
+    # Connections the OS may hold for us before we accept them.
+    request_queue_size = 128
+    
+    # Most connections parked at once, well within what select can take;
+    # past this, connections are closed after each response.
+    max_parked = 512
+    
+    def __init__(self, server_address, handler_class, workers=16, queue_size=64):
+        self._requests = Queue.Queue(queue_size)
+        # Connections being served right now.
+        self._active = set()
+        self._workers = []
+        # Parked connections, mapping each socket to its handler and the
+        # time by which it must be used again.
+        self._parked = {}
+        self._parked_lock = threading.Lock()
+        self._closing = False
+        self._waker = None
+        # Whether the connection a worker just served was parked.
+        self._local = threading.local()
+        SocketServer.TCPServer.__init__(self, server_address, handler_class)
+        
+        # Parking a connection wakes up the thread waiting on parked ones,
+        # through a datagram sent to itself; unlike a pipe, this works with
+        # select on every platform.
+        self._waker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._waker.bind(("127.0.0.1", 0))
+        self._waker.setblocking(0)
+        self._parker = threading.Thread(target=self._wait_parked, name="http-idle")
+        self._parker.daemon = True
+        self._parker.start()
+        
+        for idx in xrange(workers):
+            worker = threading.Thread(
+                target=self._work, name="http-worker-{}".format(idx)
+            )
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+            
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except Queue.Full:
+            self.shutdown_request(request)
+            
+    def park(self, handler):
+        """
+        Keeps a handler's connection open until its next request, without
+        holding on to a worker. Returns False if the connection should be
+        closed instead.
+        """
+        with self._parked_lock:
+            if self._closing or len(self._parked) >= self.max_parked:
+                return False
+            self._parked[handler.request] = (handler, time.time() + IDLE_TIMEOUT)
+            self._active.discard(handler.request)
+        # Once parked, another worker may pick the connection up at any
+        # moment, so this one must leave it alone.
+        self._local.parked = True
+        self._wake()
+        return True
+        
+    def _wake(self):
+        try:
+            self._waker.sendto("!", self._waker.getsockname())
+        except socket.error:
+            pass
+            
+    def _wait_parked(self):
+        while True:
+            with self._parked_lock:
+                if self._closing:
+                    return
+                parked = list(self._parked)
+                deadline = min([due for _, due in self._parked.values()] or [None])
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                readable = select.select([self._waker] + parked, [], [], timeout)[0]
+            except (select.error, socket.error):
+                # A connection was closed under us; look again.
+                readable = []
+            
+            if self._waker in readable:
+                try:
+                    while True:
+                        self._waker.recv(64)
+                except socket.error:
+                    pass
+                    
+            now = time.time()
+            resumed, expired = [], []
+            with self._parked_lock:
+                for request, (handler, due) in self._parked.items():
+                    if request in readable:
+                        # Clients that hang up are dealt with here, rather
+                        # than taking up a worker.
+                        if self._hung_up(request):
+                            expired.append(handler)
+                        else:
+                            resumed.append(handler)
+                    elif due <= now:
+                        expired.append(handler)
+                    else:
+                        continue
+                    del self._parked[request]
+            for handler in resumed:
+                self._requests.put(handler)
+            for handler in expired:
+                self._close_handler(handler)
+                
+    def _hung_up(self, request):
+        try:
+            return request.recv(1, socket.MSG_PEEK) == ""
+        except socket.error:
+            return True
+            
+    def _close_handler(self, handler):
+        handler.close_connection = 1
+        try:
+            handler.finish()
+        except socket.error:
+            pass
+        self.shutdown_request(handler.request)
+            
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            if isinstance(item, tuple):
+                # A new connection; its handler is set up and serves its
+                # first request as it is created.
+                request, client_address = item
+                handler = None
+            else:
+                handler = item
+                request, client_address = handler.request, handler.client_address
+            self._active.add(request)
+            self._local.parked = False
+            try:
+                if handler is None:
+                    self.finish_request(request, client_address)
+                else:
+                    handler.resume()
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if not self._local.parked:
+                    self._active.discard(request)
+                    self.shutdown_request(request)
+                
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        with self._parked_lock:
+            self._closing = True
+            parked = [handler for handler, _ in self._parked.values()]
+            self._parked.clear()
+        if self._waker is not None:
+            self._wake()
+            self._parker.join()
+            self._waker.close()
+        for handler in parked:
+            self._close_handler(handler)
+        for worker in self._workers:
+            self._requests.put(None)
+        # Wake up workers in the middle of reading a request, so that they
+        # stop right away.
+        for request in list(self._active):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for worker in self._workers:
+            worker.join()
+
+def parse_since(api_path):
+    """
+    Returns the version given as ``?since=`` in an API path, or ``None``.
+    """
+    query = urlparse.parse_qs(urlparse.urlparse(api_path).query)
+    try:
+        return int(query['since'][0])
+    except (KeyError, ValueError):
+        return None
+
+# Seconds for which an idle persistent connection is kept open.
+IDLE_TIMEOUT = 5
+
+# Largest forecast served by /api/forecast.
+MAX_FORECAST = 100
+
+# Default and largest number of entries served by one /api/log request.
+DEFAULT_LOG_LIMIT = 100
+MAX_LOG_LIMIT = 500
 
-@contextmanager
-def open_resource(respath):
-    with open(os.path.join(static_dir, respath), 'r') as f:
-        yield f
+def forecast_entry(phase):
+    """
+    Describes one forecast phase for players. Phases of NPCs are listed,
+    but without saying which NPC acts.
+    """
+    if phase.combatant is None:
+        name, kind = None, None
+    elif phase.combatant.kind == "PC":
+        name, kind = phase.combatant.name, "PC"
+    else:
+        name, kind = None, phase.combatant.kind
+    return {
+        'turn': phase.turn,
+        'segment': phase.segment,
+        'name': name,
+        'kind': kind
+    }
 
-def make_http_handler(model):
+def pc_snapshot(model):
+    """
+    Serializes every PC in the model, as served at ``/api/pcs``.
+    """
+    return json.dumps(pcs().project(model_entries(model)))
+
+def make_http_handler(model, run_batch=None, api_token=None, audiences=None):
     # This way, the request handler will close over the value of model.
     # We also want to close over some common resources.
+    #
+    # If given, run_batch is called from the server thread with a list of
+    # command lines, and must return one result per line (or None on
+    # failure). It backs the POST /api/commands route, which is only
+    # enabled when an api_token is given as well.
+    #
+    # Clients can fetch the view of any of the given audiences (by default,
+    # the built-in ones) at /api/view/<name>; private audiences need the
+    # api_token.
     
-    with open_resource("index.html") as f:
-        index = ""
-        for line in f:
-            index += line
+    deltas = PCDeltas()
+    projections = Projections(model, audiences if audiences is not None else Audiences())
 
     class HeroHTTPHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     
+        # Keep connections open between polls, closing them once idle.
+        protocol_version = "HTTP/1.1"
+        timeout = IDLE_TIMEOUT
+        # Headers and body are written separately; without this, the body
+        # of each response on a reused connection can wait on a delayed ACK.
+        disable_nagle_algorithm = True
+    
         ## METHODS #############################################################
         
+        # Set once a response is complete, so that only connections in a
+        # clean state between requests are parked.
+        between_requests = False
+        
+        def handle(self):
+            self.serve_waiting()
+            
+        def serve_waiting(self):
+            """
+            Serves the next request on this connection, along with any that
+            have already been read in behind it.
+            """
+            self.close_connection = 1
+            self.handle_one_request()
+            while not self.close_connection and self.rfile_buffered():
+                self.handle_one_request()
+            self.between_requests = True
+                
+        def rfile_buffered(self):
+            # A pipelined request may already have been read into the buffer,
+            # where select won't see it.
+            buf = getattr(self.rfile, '_rbuf', None)
+            return buf is not None and buf.tell() > 0
+            
+        def resume(self):
+            """
+            Serves the next request on a parked connection, which has just
+            become readable.
+            """
+            self.serve_waiting()
+            self.finish()
+            
+        def finish(self):
+            # Rather than waiting here for the next request, hand persistent
+            # connections back to the server until one comes in.
+            park = getattr(self.server, 'park', None)
+            if self.between_requests and not self.close_connection and park is not None:
+                self.between_requests = False
+                self.wfile.flush()
+                if park(self):
+                    return
+            SimpleHTTPServer.SimpleHTTPRequestHandler.finish(self)
+        
         def do_GET(self):
+            with tracing.span("GET " + urlparse.urlparse(self.path).path, "http"):
+                self.route_GET()
+                
+        def route_GET(self):
             if self.path == "/":
-                # Send main mobile site.
-                self.send_response(200)
-                self.send_header('Content-type','text/html')
-                self.end_headers()
-                self.wfile.write(index)
+                self.send_index()
                 
             elif self.path.startswith("/static/"):
-                res_path = self.path.partition("/static/")[2]
-                mime = mimetypes.guess_type(res_path)[0]
-                print "static_dir == " + static_dir
-                print "Loading {}, type={}".format(res_path, mime)
-                self.send_response(200)
-                self.send_header('Content-type', mime)
-                self.end_headers()
-                with open_resource(res_path) as f:
-                    for line in f:
-                        self.wfile.write(line)
-                
+                self.send_static(self.path.partition("/static/")[2])
             
             elif self.path.startswith("/api"):
-                json_resp = None
-                
-                api_path = urllib2.unquote(self.path).partition("/api")[2]
-                if api_path.startswith("/pcs"):
-                    pc_path = api_path.partition("/pcs")[2]
-                    if len(pc_path) == 0:
-                        # List all PCs.
-                        # FIXME: shouldn't use _combatants, as it's kind of
-                        #        private.
-                        json_resp = [
-                            combatant
-                            for combatant in model._combatants
-                            if combatant.kind == "PC"
-                        ]
-                    else:
-                        pc_name = pc_path.partition("/")[2]
-                        print(pc_name)
-                        try:
-                            json_resp = iter(
-                                combatant
-                                for combatant in model._combatants
-                                if combatant.kind == "PC"
-                                and combatant.name == pc_name
-                            ).next()
-                        except StopIteration:
-                            json_resp = None
-                        
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(json_resp, cls=HeroEncoder))
+                self.send_api(urllib2.unquote(self.path).partition("/api")[2])
+                
+            else:
+                self.send_body(404)
+                
+        def send_body(self, code, body="", content_type=None, headers=()):
+            """
+            Sends a whole response. Every response says how long it is, so
+            that the connection can be reused for the next request.
+            """
+            self.send_response(code)
+            if content_type is not None:
+                self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for header in headers:
+                self.send_header(*header)
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            # Static files from the bundle are buffers over its mapping,
+            # which sendall takes without copying.
+            self.connection.sendall(body)
+                
+        def send_index(self):
+            # Send main mobile site.
+            self.send_static("index.html")
+            
+        def send_static(self, res_path):
+            found = static_files().get(res_path)
+            if found is None:
+                self.send_body(404)
+                return
+            body, mime = found
+            self.send_body(200, body, mime)
+                    
+        def send_json(self, json_str):
+            self.send_body(200, json_str, 'application/json')
+                
+        def send_api(self, api_path):
+            json_resp = None
+            
+            if urlparse.urlparse(api_path).path == "/pcs" and parse_since(api_path) is not None:
+                projection = projections.get("pcs")
+                json_resp = deltas.payload(
+                    projection.version, lambda: projection.combatants,
+                    since=parse_since(api_path)
+                )
+                
+            elif api_path.startswith("/pcs"):
+                pc_path = api_path.partition("/pcs")[2]
+                if len(pc_path) == 0:
+                    # List all PCs, as already serialized.
+                    self.send_json(projections.get("pcs").json)
+                    return
+                else:
+                    pc_name = pc_path.partition("/")[2].decode('utf-8', 'replace')
+                    json_resp = projections.get("pcs").by_name.get(pc_name)
+                    
+            elif api_path.startswith("/view/"):
+                self.send_view(api_path)
+                return
                 
+            elif api_path == "/audiences":
+                json_resp = [
+                    {
+                        'name': audience.name,
+                        'private': audience.private,
+                        'description': audience.description
+                    }
+                    for audience in projections.audiences
+                ]
+                
+            elif api_path.startswith("/forecast"):
+                query = urlparse.parse_qs(urlparse.urlparse(api_path).query)
+                try:
+                    n_phases = min(int(query.get('n', [10])[0]), MAX_FORECAST)
+                except ValueError:
+                    n_phases = 10
+                json_resp = [
+                    forecast_entry(phase)
+                    for phase in model.forecast(n_phases)
+                ]
+                
+            elif api_path.startswith("/conditions"):
+                # PCs are named, while NPCs are only counted.
+                json_resp = {}
+                for condition in CONDITION_NAMES:
+                    held = model.with_condition(condition)
+                    json_resp[condition] = {
+                        'pcs': sorted(cmb.name for cmb in held if cmb.kind == "PC"),
+                        'npcs': sum(1 for cmb in held if cmb.kind != "PC")
+                    }
+                
+            elif api_path.startswith("/log"):
+                # Clients pass the "next" value of their previous response
+                # as "since", and so only receive new entries.
+                query = urlparse.parse_qs(urlparse.urlparse(api_path).query)
+                try:
+                    since = int(query.get('since', [0])[0])
+                    limit = int(query.get('limit', [DEFAULT_LOG_LIMIT])[0])
+                except ValueError:
+                    since, limit = 0, DEFAULT_LOG_LIMIT
+                limit = max(0, min(limit, MAX_LOG_LIMIT))
+                entries = model.log.since(since, limit)
+                json_resp = {
+                    'entries': [entry for entry in entries if entry['public']],
+                    'next': entries[-1]['seq'] if entries else max(since, model.log.first_seq - 1),
+                    'last': model.log.last_seq
+                }
+                    
+            self.send_json(json.dumps(json_resp, cls=HeroEncoder))
+            
+        def send_view(self, api_path):
+            # Serves /view/<name>[?since=<version>]. A client that already
+            # has the current version is only told so.
+            name = urlparse.unquote(urlparse.urlparse(api_path).path.partition("/view/")[2])
+            try:
+                name = name.decode('utf-8')
+            except UnicodeDecodeError:
+                self.send_body(404)
+                return
+            audience = projections.audiences.get(name)
+            if audience is None:
+                self.send_body(404)
+                return
+            if audience.private and not self.authorized():
+                self.send_body(401, headers=[('WWW-Authenticate', 'Bearer')])
+                return
+            projection = projections.get(name)
+            if parse_since(api_path) == projection.version:
+                self.send_json(json.dumps({
+                    'version': projection.version, 'unchanged': True
+                }))
             else:
-                self.send_response(404)
-                self.end_headers()
+                self.send_json('{{"version": {}, "combatants": {}}}'.format(
+                    projection.version, projection.json
+                ))
+                
+        def authorized(self):
+            """
+            Returns True if the request carries the API token.
+            """
+            if api_token is None:
+                return False
+            auth = self.headers.getheader('Authorization', '')
+            scheme, _, token = auth.partition(" ")
+            return scheme.lower() == "bearer" and hmac.compare_digest(token.strip(), api_token)
+                
+        def do_POST(self):
+            with tracing.span("POST " + urlparse.urlparse(self.path).path, "http"):
+                self.route_POST()
+                
+        def route_POST(self):
+            # Responses sent before reading the request body end the
+            # connection, since the body is still in the way of the next
+            # request.
+            if self.path != "/api/commands" or run_batch is None or api_token is None:
+                self.close_connection = 1
+                self.send_body(404)
+                return
+                
+            # Check the token before looking at the request body.
+            if not self.authorized():
+                self.close_connection = 1
+                self.send_body(401, headers=[('WWW-Authenticate', 'Bearer')])
+                return
+                
+            # Accept either a bare list of commands or {"commands": [...]}.
+            try:
+                length = int(self.headers.getheader('Content-Length', 0))
+                body = json.loads(self.rfile.read(length))
+                if isinstance(body, dict):
+                    body = body['commands']
+                if not isinstance(body, list) or not all(
+                    isinstance(line, basestring) for line in body
+                ):
+                    raise ValueError("Expected a list of commands.")
+            except (ValueError, KeyError):
+                self.close_connection = 1
+                self.send_body(400)
+                return
+                
+            results = run_batch([line.encode('utf-8') for line in body])
+            if results is None:
+                self.send_body(503)
                 return
                 
+            self.send_json(json.dumps(results))
+                
     return HeroHTTPHandler
     
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# library.py: Persistent library of character templates.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import os
+import sqlite3
+from collections import namedtuple
+
+from combat_model import Combatant
+
+## CONSTANTS ###################################################################
+
+DEFAULT_LIBRARY_PATH = os.path.join(os.path.expanduser("~"), ".hero_init", "library.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS templates (
+    name   TEXT PRIMARY KEY,
+    spd    INTEGER NOT NULL,
+    dex    INTEGER NOT NULL,
+    stun   INTEGER NOT NULL,
+    body   INTEGER NOT NULL,
+    end    INTEGER NOT NULL,
+    kind   TEXT NOT NULL,
+    status TEXT NOT NULL,
+    rec    INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag  TEXT NOT NULL,
+    name TEXT NOT NULL REFERENCES templates(name) ON DELETE CASCADE,
+    PRIMARY KEY (tag, name)
+);
+CREATE INDEX IF NOT EXISTS tags_by_name ON tags (name);
+"""
+
+## CLASSES #####################################################################
+
+Template = namedtuple("Template", "name spd dex stun body end kind status rec")
+
+class CharacterLibrary(object):
+    """
+    Character templates stored in an SQLite database, indexed by name and by
+    tag. Templates record the maximum STUN, BODY and END of a character, so
+    that spawned combatants start out fresh.
+    """
+    
+    # Maximum number of names returned by a single search.
+    MAX_RESULTS = 50
+    
+    def __init__(self, path=DEFAULT_LIBRARY_PATH):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(SCHEMA)
+        
+        # Libraries written before REC was tracked lack its column.
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(templates)")]
+        if "rec" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE templates ADD COLUMN rec INTEGER NOT NULL DEFAULT 0")
+        
+    @property
+    def path(self):
+        return self._path
+        
+    def close(self):
+        self._conn.close()
+        
+    def save(self, combatant, tags=()):
+        """
+        Saves a combatant as a template under its own name, replacing any
+        template of the same name. The template's tags are replaced by
+        ``tags`` if any are given, and otherwise kept.
+        """
+        name = _u(combatant.name)
+        values = (
+            combatant.spd, combatant.dex,
+            combatant.stun.max, combatant.body.max, combatant.end.max,
+            _u(combatant.kind), _u(combatant.status), combatant.rec
+        )
+        with self._conn:
+            # INSERT OR REPLACE would delete the old row first, and its tags
+            # along with it, so update the template in place if it exists.
+            cur = self._conn.execute(
+                "UPDATE templates SET spd = ?, dex = ?, stun = ?, body = ?, end = ?,"
+                " kind = ?, status = ?, rec = ? WHERE name = ?",
+                values + (name, )
+            )
+            if cur.rowcount == 0:
+                self._conn.execute(
+                    "INSERT INTO templates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (name, ) + values
+                )
+            if tags:
+                self._conn.execute("DELETE FROM tags WHERE name = ?", (name, ))
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO tags VALUES (?, ?)",
+                    [(_u(tag), name) for tag in tags]
+                )
+            
+    def delete(self, name):
+        """
+        Removes a template, returning ``True`` if it existed.
+        """
+        with self._conn:
+            cur = self._conn.execute("DELETE FROM templates WHERE name = ?", (_u(name), ))
+        return cur.rowcount > 0
+        
+    def get(self, name):
+        """
+        Returns the :class:`Template` named ``name``, or ``None``.
+        """
+        row = self._conn.execute(
+            "SELECT " + ", ".join(Template._fields) + " FROM templates WHERE name = ?",
+            (_u(name), )
+        ).fetchone()
+        return Template(*row) if row is not None else None
+        
+    def find(self, prefix):
+        """
+        Returns the sorted names of templates whose name, or one of whose
+        tags, starts with ``prefix``. Both searches are range scans over an
+        index, so they stay fast for large libraries.
+        """
+        prefix = _u(prefix)
+        if prefix:
+            where = "{col} >= ? AND {col} < ?"
+            args = (prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+        else:
+            where = "1"
+            args = ()
+        rows = self._conn.execute(
+            "SELECT name FROM templates WHERE " + where.format(col="name") +
+            " UNION SELECT name FROM tags WHERE " + where.format(col="tag") +
+            " ORDER BY name LIMIT ?",
+            args * 2 + (self.MAX_RESULTS, )
+        )
+        return [row[0] for row in rows]
+        
+    def tags(self, name):
+        return [
+            row[0] for row in self._conn.execute(
+                "SELECT tag FROM tags WHERE name = ? ORDER BY tag", (_u(name), )
+            )
+        ]
+        
+    def spawn(self, name, count=1, taken=()):
+        """
+        Builds ``count`` new combatants from the template ``name``. Spawned
+        combatants are named after the template, numbered if needed to avoid
+        the names in ``taken``. Raises :class:`KeyError` if there is no such
+        template.
+        """
+        template = self.get(name)
+        if template is None:
+            raise KeyError(name)
+        
+        taken = set(taken)
+        if count == 1 and template.name not in taken:
+            names = [template.name]
+        else:
+            names = []
+            idx = 1
+            while len(names) < count:
+                candidate = "{} {}".format(template.name, idx)
+                if candidate not in taken:
+                    names.append(candidate)
+                idx += 1
+        
+        return [
+            Combatant(
+                cmb_name, template.spd, template.dex,
+                template.stun, template.body, template.end,
+                status=template.status, kind=template.kind, rec=template.rec
+            )
+            for cmb_name in names
+        ]
+        
+## FUNCTIONS ###################################################################
+
+def _u(s):
+    # sqlite3 only accepts text as unicode.
+    return s.decode('utf-8') if isinstance(s, str) else s
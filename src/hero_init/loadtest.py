@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# loadtest.py: Simulates a table full of phones polling the player server.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Starts the player server against a synthetic combat, then has simulated
+phones load the player page and poll the PCs while a GM thread runs
+commands. Reports server throughput and latency, errors, and how much
+slower GM commands became under load.
+"""
+
+## IMPORTS #####################################################################
+
+import sys
+import json
+import time
+import random
+import httplib
+import argparse
+import threading
+
+from PySide import QtCore
+
+from combat_model import SpeedChartModel, Combatant
+from http_handler import make_http_handler, PooledHTTPServer
+from main_window import MainCommand
+from replay import HeadlessWindow, percentile
+
+## CONSTANTS ###################################################################
+
+# Assets fetched by a phone when it first loads the player page.
+PAGE_ASSETS = [
+    "/",
+    "/static/bootstrap/css/bootstrap.css",
+    "/static/bootstrap/css/bootstrap-responsive.css",
+    "/static/bootstrap/js/bootstrap.min.js",
+]
+
+## CLASSES #####################################################################
+
+class Stats(object):
+    """
+    Latencies and errors collected from many threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        
+    def add(self, latency, ok=True):
+        with self._lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+                
+class Phone(threading.Thread):
+    """
+    One simulated player device: loads the page, then polls the PCs until
+    told to stop, reloading the page every ``reload_every`` polls.
+    """
+    def __init__(self, port, stats, poll_interval, reload_every, stop, use_deltas, keep_alive):
+        super(Phone, self).__init__()
+        self.daemon = True
+        self._port = port
+        self._stats = stats
+        self._poll_interval = poll_interval
+        self._reload_every = reload_every
+        self._stop = stop
+        self._use_deltas = use_deltas
+        self._version = -1
+        # With keep_alive, one connection is reused for as long as the server
+        # keeps it open.
+        self._keep_alive = keep_alive
+        self._conn = None
+        
+    def fetch(self, path):
+        start = time.time()
+        # Like a browser, retry once on a fresh connection if the server
+        # closed a reused one while the request was in flight.
+        for attempt in (0, 1):
+            reused = self._conn is not None
+            try:
+                if self._conn is None:
+                    self._conn = httplib.HTTPConnection("127.0.0.1", self._port, timeout=10)
+                self._conn.request("GET", path)
+                resp = self._conn.getresponse()
+                body = resp.read()
+                if not self._keep_alive or resp.will_close:
+                    self._conn.close()
+                    self._conn = None
+                ok = resp.status == 200
+                break
+            except Exception:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+                body, ok = None, False
+                if not reused:
+                    break
+        self._stats.add(time.time() - start, ok)
+        return body if ok else None
+        
+    def run(self):
+        # Spread the phones out, rather than having them all poll at once.
+        time.sleep(random.uniform(0, self._poll_interval))
+        n_polls = 0
+        while not self._stop.is_set():
+            if n_polls % self._reload_every == 0:
+                for path in PAGE_ASSETS:
+                    self.fetch(path)
+            if self._use_deltas:
+                body = self.fetch("/api/pcs?since={}".format(self._version))
+                if body is not None:
+                    self._version = json.loads(body)['version']
+            else:
+                self.fetch("/api/pcs")
+            n_polls += 1
+            self._stop.wait(self._poll_interval)
+            
+## FUNCTIONS ###################################################################
+
+def make_combat(n_pcs, n_npcs):
+    model = SpeedChartModel()
+    model.add_combatants(
+        [
+            Combatant("PC {}".format(idx), random.randint(2, 6), random.randint(10, 25),
+                      50, 15, 50, kind="PC", rec=8)
+            for idx in xrange(n_pcs)
+        ] + [
+            Combatant("NPC {}".format(idx), random.randint(2, 6), random.randint(10, 25),
+                      30, 10, 30, kind="NPC", rec=5)
+            for idx in xrange(n_npcs)
+        ]
+    )
+    model.skip_to(1)
+    return model
+    
+def drive_gm(interp, names, n_commands, interval):
+    """
+    Runs GM commands (alternating between advancing the turn and dealing
+    damage), returning the latency of each.
+    """
+    latencies = []
+    for idx in xrange(n_commands):
+        if idx % 2 == 0:
+            line = "n"
+        else:
+            line = 'dmg "{}" S 1'.format(random.choice(names))
+        start = time.time()
+        interp.onecmd(line)
+        latencies.append(time.time() - start)
+        time.sleep(interval)
+    return latencies
+    
+def run_load_test(args):
+    _ = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+    
+    model = make_combat(args.pcs, args.npcs)
+    interp = MainCommand(model, HeadlessWindow())
+    names = [cmb.name for cmb in model._combatants]
+    
+    class QuietHandler(make_http_handler(model)):
+        def log_message(self, *args):
+            pass
+            
+    server = PooledHTTPServer(("127.0.0.1", args.port), QuietHandler, workers=args.workers)
+    port = server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    
+    # Measure the GM on their own first, to have something to compare with.
+    baseline = drive_gm(interp, names, args.gm_commands, args.gm_interval)
+    
+    stats = Stats()
+    stop = threading.Event()
+    phones = [
+        Phone(port, stats, args.poll_interval, args.reload_every, stop, args.deltas, args.keep_alive)
+        for idx in xrange(args.clients)
+    ]
+    start = time.time()
+    for phone in phones:
+        phone.start()
+    loaded = []
+    while time.time() - start < args.duration:
+        loaded += drive_gm(interp, names, args.gm_commands, args.gm_interval)
+    stop.set()
+    for phone in phones:
+        phone.join()
+    elapsed = time.time() - start
+    
+    server.shutdown()
+    server.server_close()
+    
+    return {
+        'clients': args.clients,
+        'elapsed': elapsed,
+        'requests': len(stats.latencies),
+        'errors': stats.errors,
+        'latencies': sorted(stats.latencies),
+        'gm_baseline': sorted(baseline),
+        'gm_loaded': sorted(loaded)
+    }
+    
+def print_report(report, out=sys.stdout):
+    ms = lambda seconds: "{:8.3f} ms".format(1000 * seconds)
+    print >>out, "Clients:        {}".format(report['clients'])
+    print >>out, "Requests:       {} in {:.1f} s ({:.1f}/s)".format(
+        report['requests'], report['elapsed'], report['requests'] / report['elapsed']
+    )
+    print >>out, "Errors:         {}".format(report['errors'])
+    print >>out, "Server latency:"
+    for pct in (50, 90, 99, 100):
+        print >>out, "    p{:<3}        {}".format(pct, ms(percentile(report['latencies'], pct)))
+    print >>out, "GM command latency (alone / under load):"
+    for pct in (50, 90, 99, 100):
+        alone = percentile(report['gm_baseline'], pct)
+        loaded = percentile(report['gm_loaded'], pct)
+        print >>out, "    p{:<3}        {} / {}  ({:+.0f}%)".format(
+            pct, ms(alone), ms(loaded),
+            100 * (loaded - alone) / alone if alone > 0 else 0
+        )
+        
+## MAIN ########################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--clients", type=int, default=20,
+        help="number of simulated phones (default: 20)")
+    parser.add_argument("--duration", type=float, default=10,
+        help="seconds to keep the phones polling (default: 10)")
+    parser.add_argument("--poll-interval", type=float, default=0.5,
+        help="seconds between two polls of one phone (default: 0.5)")
+    parser.add_argument("--reload-every", type=int, default=100,
+        help="polls between two reloads of the whole page (default: 100)")
+    parser.add_argument("--deltas", action="store_true",
+        help="poll /api/pcs?since= rather than the full PC list")
+    parser.add_argument("--keep-alive", action="store_true",
+        help="reuse one connection per phone, as browsers do")
+    parser.add_argument("--workers", type=int, default=16,
+        help="worker threads serving requests (default: 16)")
+    parser.add_argument("--pcs", type=int, default=6,
+        help="number of PCs in the synthetic combat (default: 6)")
+    parser.add_argument("--npcs", type=int, default=20,
+        help="number of NPCs in the synthetic combat (default: 20)")
+    parser.add_argument("--gm-commands", type=int, default=50,
+        help="GM commands per round of driving (default: 50)")
+    parser.add_argument("--gm-interval", type=float, default=0.01,
+        help="seconds between two GM commands (default: 0.01)")
+    parser.add_argument("--port", type=int, default=0,
+        help="port for the server (default: any free port)")
+    print_report(run_load_test(parser.parse_args(argv[1:])))
+    return 0
+    
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -24,9 +24,10 @@
 
 ## IMPORTS #####################################################################
 
+import os
 import sys
-import socket
-import SocketServer
+import time
+import binascii
 import threading
 from PySide import QtCore, QtGui
 
@@ -36,7 +37,13 @@ import shlex, cmd, contextlib
 from functools import wraps
 
 from combat_model import *
-from http_handler import *
+import tracing
+import startup_profile
+from trie import PrefixTrie
+
+# The webserver, audiences, the character library, dice, rosters and
+# recordings are imported when first used, so that none of them slow down
+# opening the window.
 
 ## DECORATORS ##################################################################
 
@@ -52,26 +59,134 @@ def shlexify(func):
 
 ## FUNCTIONS ###################################################################
 
-def get_local_hostname():
-    # Try to just get the hostname from socket.
-    hostname = socket.gethostbyname(socket.gethostname())
-    
-    # This sometimes returns 127.0.0.1, so if so we need to be more hackish.
-    # See: http://stackoverflow.com/a/166589/267841
-    if hostname == "127.0.0.1":
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            hostname = s.getsockname()[0]
-        finally:
-            s.close()
+def to_unicode(s):
+    # Names typed at the command line are UTF-8 byte strings.
+    return s.decode('utf-8') if isinstance(s, str) else s
+
+# Addresses used to find out which local address would be used to reach
+# each kind of network: the default route, then each private IPv4 range.
+# Connecting a UDP socket sends nothing, and these are IP addresses, so no
+# lookup of any kind is made.
+ADDRESS_PROBES = [
+    "192.0.2.1", "10.255.255.254", "172.31.255.254", "192.168.255.254"
+]
+
+# Seconds for which the local addresses found are reused.
+ADDRESS_CACHE_TTL = 60
+
+_address_cache = (0, None)
+_address_cache_lock = threading.Lock()
+
+def get_local_addresses():
+    """
+    Returns every local IPv4 address that players on the LAN could use to
+    reach this machine, most likely first, or ``["127.0.0.1"]`` if there are
+    none.
+    """
+    import socket
+    
+    global _address_cache
+    with _address_cache_lock:
+        found_at, addresses = _address_cache
+        if addresses is not None and time.time() - found_at < ADDRESS_CACHE_TTL:
+            return list(addresses)
             
-    return hostname
+        addresses = []
+        for probe in ADDRESS_PROBES:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.connect((probe, 9))
+                address = s.getsockname()[0]
+            except socket.error:
+                # No route to that network.
+                continue
+            finally:
+                s.close()
+            if not address.startswith("127.") and address != "0.0.0.0" \
+                    and address not in addresses:
+                addresses.append(address)
+                
+        if not addresses:
+            addresses = ["127.0.0.1"]
+        _address_cache = (time.time(), addresses)
+        return list(addresses)
 
 ## CLASSES #####################################################################
 
+class CommandBridge(QtCore.QObject):
+    """
+    Marshals batches of commands submitted from server threads onto the Qt
+    thread, where they are run by a :class:`MainCommand`.
+    """
+    
+    # Seconds that a server thread will wait for the Qt thread to run a batch.
+    TIMEOUT = 30
+    
+    # Commands that batches submitted from the server may not run: stopping
+    # the server from one of its own threads would wait on that thread
+    # forever, and the rest read or write files on the GM's computer.
+    REFUSED = [["server"], ["record"], ["run"], ["runpost12"], ["lib", "open"]]
+    
+    batch_submitted = QtCore.Signal(object)
+    
+    def __init__(self, cmd, parent=None):
+        super(CommandBridge, self).__init__(parent)
+        self._cmd = cmd
+        self.batch_submitted.connect(self._run_batch, QtCore.Qt.QueuedConnection)
+        
+    def submit(self, lines):
+        """
+        Runs the given command lines on the Qt thread and blocks until they
+        have completed, returning the results of
+        :meth:`MainCommand.run_batch`, or ``None`` if the Qt thread did not
+        respond in time.
+        """
+        job = {
+            'lines': list(lines), 'done': threading.Event(), 'results': None,
+            'lock': threading.Lock(), 'started': False, 'cancelled': False
+        }
+        self.batch_submitted.emit(job)
+        if not job['done'].wait(self.TIMEOUT):
+            # Make sure that a batch reported as failed never runs later on.
+            # If it has already started, it will finish, so wait for it.
+            with job['lock']:
+                job['cancelled'] = not job['started']
+            if not job['cancelled']:
+                job['done'].wait()
+        return job['results']
+        
+    def _run_batch(self, job):
+        with job['lock']:
+            if job['cancelled']:
+                return
+            job['started'] = True
+        try:
+            job['results'] = self._cmd.run_batch(job['lines'], refused=self.REFUSED)
+        finally:
+            job['done'].set()
+
 class MainWindow(QtGui.QMainWindow):
 
+    ## SIGNALS #################################################################
+    
+    # Emitted from the thread starting the server, with the running server's
+    # details or with an error message.
+    server_started = QtCore.Signal(object)
+    server_failed = QtCore.Signal(str)
+
+    ## CONSTANTS ###############################################################
+    
+    # Minimum time, in milliseconds, between two refreshes of the status
+    # panel. Model changes arriving in the meantime are folded into the
+    # pending refresh.
+    REFRESH_INTERVAL = 1000 // 30
+    
+    # Number of command line hints to cache before starting over.
+    MAX_CACHED_HINTS = 512
+    
+    # Number of upcoming phases listed below the current combatant.
+    N_FORECAST = 6
+
     ## CONSTRUCTOR #############################################################
     
     def __init__(self, parent=None):
@@ -84,6 +199,13 @@ class MainWindow(QtGui.QMainWindow):
         self.proxy_model = SpeedChartProxyModel(self)
         self.proxy_model.setSourceModel(self.spd_model)
         self.proxy_model.sort(0, QtCore.Qt.DescendingOrder)
+        # Time the proxy keeping rows in order as the model changes.
+        self.proxy_model.layoutAboutToBeChanged.connect(
+            lambda: tracing.begin("proxy re-sort", "qt")
+        )
+        self.proxy_model.layoutChanged.connect(
+            lambda: tracing.end("proxy re-sort", "qt")
+        )
         self.ui.tbl_spd_chart.setModel(self.proxy_model)
         
         # Set resize modes for the table view.
@@ -109,18 +231,54 @@ class MainWindow(QtGui.QMainWindow):
         self.ui.tbl_spd_chart.horizontalHeader().resizeSection(17, 60)
         # Status
         self.ui.tbl_spd_chart.horizontalHeader().setResizeMode(18, QtGui.QHeaderView.Stretch)
+        
+        # List upcoming phases just below the current combatant.
+        self.lbl_forecast = QtGui.QLabel(self.ui.centralwidget)
+        self.lbl_forecast.setWordWrap(True)
+        self.ui.verticalLayout_3.insertWidget(
+            self.ui.verticalLayout_3.indexOf(self.ui.horizontalLayout_6) + 1,
+            self.lbl_forecast
+        )
+        
         # Connect signals and slots.
         self.ui.le_cmd.returnPressed.connect(self.on_cmd_go)
         self.ui.le_cmd.textChanged.connect(self.on_cmd_edit)
         self.ui.btn_cmd.clicked.connect(self.on_cmd_go)
+        # Tab completes the command line instead of moving the focus.
+        self.ui.le_cmd.installEventFilter(self)
+        
+        # Hints already shown, by command line text, valid for as long as
+        # the names of the combatants don't change.
+        self._hints = {}
+        self._hints_generation = None
+        
+        # Model changes only schedule a refresh, so that a burst of changes
+        # (a script, post-12 recovery, ...) costs a single UI update.
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.setInterval(self.REFRESH_INTERVAL)
+        self._refresh_timer.timeout.connect(self.refresh)
         self.spd_model.dataChanged.connect(self.on_model_change)
         self.spd_model.modelReset.connect(self.on_model_change)
+        self.spd_model.rowsInserted.connect(self.on_model_change)
         
         # Setup command interface.
         self.cmd = MainCommand(self.spd_model, self)
+        self.cmd_bridge = CommandBridge(self.cmd, self)
         
         # Prepare for serving via HTTP.
         self._server = None
+        self._server_proc = None
+        self._snapshot = None
+        self._api_token = None
+        self._server_starting = False
+        self._stop_requested = False
+        self._audiences = None
+        self.server_started.connect(self.on_server_started)
+        self.server_failed.connect(self.on_server_failed)
+        
+        # The player window is created when first shown.
+        self.player_window = None
         
     ## DESTRUCTOR ##############################################################
     
@@ -143,44 +301,135 @@ class MainWindow(QtGui.QMainWindow):
     def cmd_hint(self, newval):
         self.ui.lbl_cmd_hints.setText(newval)
         
+    @property
+    def audiences(self):
+        # Who the webserver serves, and what each may see. Created on first
+        # use, as the audiences module loads json.
+        if self._audiences is None:
+            from audiences import Audiences
+            self._audiences = Audiences()
+        return self._audiences
+        
     ## METHODS #################################################################
     
     def disp_error(self, err_str):
-        self.ui.lbl_cmd_hints.setText('<b>{}</b>'.format(err_str))
+        self.ui.lbl_cmd_hints.setText(u'<b>{}</b>'.format(to_unicode(err_str)))
     
-    def start_server(self, ip='', port=8080):
-        if self._server is None:
-            print "Starting server on port {}.".format(port)
+    def start_server(self, ip='', port=8080, mode="thread"):
+        """
+        Starts the player server on the given port. In ``"thread"`` mode, the
+        server runs on threads of this process and has access to the whole
+        model. In ``"process"`` mode, it runs as a separate process that only
+        serves PCs, from snapshots published by :meth:`refresh`, so that
+        player traffic can't slow down the GM's window.
+        
+        Binding the port and looking up local addresses happen on a separate
+        thread, which reports back through :attr:`server_started` or
+        :attr:`server_failed`, so the window never waits on the network.
+        """
+        if self._server is not None or self._server_proc is not None \
+                or self._server_starting:
+            return
+            
+        print "Starting server on port {}.".format(port)
+        self._server_starting = True
+        self._stop_requested = False
+        self.ui.lbl_server_status.setText("Starting...")
+        
+        import snapshot_server
+        from http_handler import make_http_handler, pc_snapshot, PooledHTTPServer
+        
+        if mode == "process":
+            # The snapshot is written from this thread only, so set it up here.
+            snapshot = snapshot_server.SnapshotWriter()
+            snapshot.write(pc_snapshot(self.spd_model))
+            handler = None
+        else:
+            snapshot = None
+            # Each server run gets a fresh token for the command API.
+            api_token = binascii.hexlify(os.urandom(8))
+            handler = make_http_handler(
+                self.spd_model,
+                run_batch=self.cmd_bridge.submit,
+                api_token=api_token,
+                audiences=self.audiences
+            )
+            
+        def start():
             try:
-                self._server = SocketServer.ThreadingTCPServer(
-                    (ip, port), make_http_handler(self.spd_model)
-                )
-                self._server_thread = threading.Thread(
-                    target=lambda: self._server.serve_forever()
-                )
-                self._server_thread.start()
-                self.ui.lbl_server_status.setText(
-                    'Online at <a href="{0}">{0}</a>'.format(
-                        "http://{host}:{port}".format(
-                            host=get_local_hostname(),
-                            port=port
-                        )
+                running = {'port': port, 'snapshot': snapshot}
+                if snapshot is not None:
+                    running['proc'] = snapshot_server.launch(snapshot.path, port)
+                    running['details'] = "separate process"
+                else:
+                    server = PooledHTTPServer((ip, port), handler)
+                    server_thread = threading.Thread(target=server.serve_forever)
+                    # If the window closes before it hears that the server
+                    # is up, nothing will stop the server, so don't let it
+                    # keep hero_init running.
+                    server_thread.daemon = True
+                    server_thread.start()
+                    running.update(
+                        server=server, thread=server_thread, api_token=api_token,
+                        details="API token: {}".format(api_token)
                     )
-                )
+                running['addresses'] = get_local_addresses()
             except Exception as ex:
-                self.disp_error(str(ex))
+                if snapshot is not None:
+                    snapshot.close()
+                self.server_failed.emit(str(ex))
+            else:
+                self.server_started.emit(running)
+                
+        starter = threading.Thread(target=start)
+        starter.daemon = True
+        starter.start()
             
     def stop_server(self):
+        if self._server_starting:
+            # Stop as soon as the server is up.
+            self._stop_requested = True
         if self._server is not None:
             self._server.shutdown()
+            self._server.server_close()
             self._server_thread.join()
             self._server = None
             self._server_thread = None
+            self._api_token = None
             self.ui.lbl_server_status.setText("Offline")
+        if self._server_proc is not None:
+            self._server_proc.terminate()
+            self._server_proc.wait()
+            self._server_proc = None
+            self._snapshot.close()
+            self._snapshot = None
+            self.ui.lbl_server_status.setText("Offline")
+            
+    def show_players(self, full_screen=False):
+        """
+        Shows the player window, full-screen on the second screen if asked.
+        """
+        if self.player_window is None:
+            from player_window import PlayerWindow
+            # As a child of this window, it doesn't keep hero_init running
+            # once this window is closed.
+            self.player_window = PlayerWindow(self.spd_model, self)
+        if full_screen:
+            self.player_window.show_on_second_screen()
+        else:
+            self.player_window.show()
+            
+    def hide_players(self):
+        if self.player_window is not None:
+            self.player_window.hide()
         
-    ## EVENTS ##################################################################
-        
-    def on_model_change(self, *args):
+    @tracing.traced("refresh", "qt")
+    def refresh(self):
+        """
+        Redraws the status panel from the current state of the model. Called
+        at most once every ``REFRESH_INTERVAL`` milliseconds; the table view
+        repaints itself from the model.
+        """
         self.ui.lbl_now_turn.setText(str(self.spd_model.turn))
         self.ui.lbl_now_seg.setText(str(self.spd_model.segment))
         
@@ -205,15 +454,78 @@ class MainWindow(QtGui.QMainWindow):
             self.ui.lbl_now_body.setText(str(""))
             self.ui.lbl_now_end.setText(str(""))
             
+        self.lbl_forecast.setText(u"<b>Up next:</b> " + u", ".join(
+            u"{} ({}/{})".format(to_unicode(phase.combatant.display_name), phase.turn, phase.segment)
+            if phase.combatant is not None else u"Post-Segment 12"
+            for phase in self.spd_model.forecast(self.N_FORECAST)
+        ))
+        
+        # Publish the PCs to an out-of-process server, if there is one.
+        if self._snapshot is not None:
+            from http_handler import pc_snapshot
+            self._snapshot.write(pc_snapshot(self.spd_model))
+        
+    ## EVENTS ##################################################################
+    
+    def on_server_started(self, running):
+        self._server_starting = False
+        self._server = running.get('server')
+        self._server_thread = running.get('thread')
+        self._server_proc = running.get('proc')
+        self._snapshot = running['snapshot']
+        self._api_token = running.get('api_token')
+        self.ui.lbl_server_status.setText('Online at {0} ({1})'.format(
+            ", ".join(
+                '<a href="{0}">{0}</a>'.format(
+                    "http://{host}:{port}".format(host=address, port=running['port'])
+                )
+                for address in running['addresses']
+            ),
+            running['details']
+        ))
+        if self._stop_requested:
+            self.stop_server()
+            
+    def on_server_failed(self, err_str):
+        self._server_starting = False
+        self.ui.lbl_server_status.setText("Offline")
+        self.disp_error(err_str)
+        
+    @tracing.traced("on_model_change", "qt")
+    def on_model_change(self, *args):
+        # Mark the status panel as dirty by starting the refresh timer, unless
+        # a refresh is already pending.
+        if not self._refresh_timer.isActive():
+            self._refresh_timer.start()
         
     def on_cmd_edit(self):
         cmd = self.cmd_text
-        cmd_parts = cmd.split(" ", 2)
-        cmd_name = cmd_parts[0] if len(cmd_parts) > 0 else ""
-        if cmd_name in self.cmd.VALID_CMDS:
-            self.cmd_hint = self.cmd.USAGES[cmd_name]
-        else:
-            self.cmd_hint = "Available commands: " + ", ".join(self.cmd.VALID_CMDS)
+        generation = self.spd_model.names.generation
+        if generation != self._hints_generation or \
+                len(self._hints) >= self.MAX_CACHED_HINTS:
+            self._hints = {}
+            self._hints_generation = generation
+            
+        hint = self._hints.get(cmd)
+        if hint is None:
+            hint = self._hints[cmd] = self.cmd.hint(cmd)
+        self.cmd_hint = hint
+        
+    def on_cmd_tab(self):
+        cmd = self.cmd_text
+        word, matches = self.cmd.complete_line(cmd)
+        start = self.cmd.word_start(cmd)
+        if len(matches) == 1:
+            self.cmd_text = cmd[:start] + matches[0] + " "
+        elif len(word) > len(cmd) - start:
+            self.cmd_text = cmd[:start] + word
+        
+    def eventFilter(self, obj, event):
+        if obj is self.ui.le_cmd and event.type() == QtCore.QEvent.KeyPress \
+                and event.key() == QtCore.Qt.Key_Tab:
+            self.on_cmd_tab()
+            return True
+        return super(MainWindow, self).eventFilter(obj, event)
         
     def on_cmd_go(self):
         cmd = self.cmd_text
@@ -222,7 +534,7 @@ class MainWindow(QtGui.QMainWindow):
         # Check that the command is good.
         cmd_parts = cmd.split(" ", 2)
         cmd_name = cmd_parts[0].strip() if len(cmd_parts) > 0 else ""
-        if cmd_name in self.cmd.VALID_CMDS:
+        if cmd_name in self.cmd.COMMANDS:
             self.cmd.onecmd(cmd)
         else:
             print "Error!", '"{}"'.format(cmd_name), self.cmd.VALID_CMDS, len(cmd_name)
@@ -234,22 +546,69 @@ class MainCommand(cmd.Cmd):
     # TODO: populate from methods.
     USAGES = {
         "add": "add <name> <spd> <dex> <stun> <body> <end> [PC | NPC] [<status>] - Adds new combatant.",
+        "addgroup": "addgroup <name> <count> <spd> <dex> <stun> <body> <end> [PC | NPC] [<status>] - Adds a group of identical combatants.",
         "del": "del <name> - Removes combatant.",
+        "import": "import <file> - Adds every combatant from a CSV or JSON roster.",
+        "lib": "lib [save <name> [<tag> ...] | find <prefix> | del <name> | open <file>] - Manages the character library.",
+        "spawn": "spawn <template> [<count>] - Adds combatants from a library template.",
         "n": "n - Alias for 'next'.",
         "next": "next - Advances turn order.",
         "abort": "abort <name> - Aborts the next phase for a given combatant.",
-        "d": "d <name> [S | B| E] <amount> - Alias for 'd'.",
-        "dmg": "dmg <name> [S | B| E] <amount> - Applies damage.",
-        "h": "h <name> [S | B| E] <amount> - Alias for 'h'.",
-        "heal": "heal <name> [S | B| E] <amount> - Heals damage.",
+        "d": "d <targets> [S | B| E] <amount> [<falloff>] - Alias for 'dmg'.",
+        "dmg": "dmg <targets> [S | B| E] <amount> [<falloff>] - Applies damage to one or more comma-separated names, globs (Agent*) or kinds (@NPC), each target taking <falloff> less than the last.",
+        "roll": "roll <dice> [N | K] [<hits>] - Rolls normal or killing damage, e.g. 'roll 12d6'.",
+        "attack": "attack <attacker> <targets> <dice> [N | K] [<hits>] - Rolls damage and applies it to the targets.",
+        "h": "h <targets> [S | B| E] <amount> [<falloff>] - Alias for 'heal'.",
+        "heal": "heal <targets> [S | B| E] <amount> [<falloff>] - Heals damage.",
         "stat": "stat <name> [<new_status>] - Changes or clears status string.",
+        "rec": "rec <name> [<rec> | on | off] - Sets REC, or turns post-12 recovery on or off for one combatant.",
         "chspd": "chspd <name> <new_spd> - Changes SPD of one combatant.",
         "run": "run <file> - Runs a hero_init script.",
-        "runpost12": "runpost12 <file> - Sets a given script to run post-segment 12.",
+        "record": "record [<file> | stop] - Records every command to a file, for replay.py.",
+        "runpost12": "runpost12 <file> - Sets a given script to run post-segment 12. The script is read once; run again to reload it.",
         "skipto": "skipto <seg> - Skips turns until a given segment is reached.",
-        "server": "server [start | stop] [<port>] - Starts or stops the embedded webserver."
+        "advance": "advance [<turns>] - Fast-forwards to post-segment 12 of the given number of Turns from now.",
+        "advance_until": "advance_until <targets> [not] [unconscious | dying | exhausted] [<max_turns>] - Fast-forwards Turn by Turn until every target has, or lacks, a condition.",
+        "server": "server [start | stop] [<port>] [thread | process] - Starts or stops the embedded webserver.",
+        "players": "players [show | full | hide] - Shows or hides a window of the PCs for a screen facing the players.",
+        "audience": "audience [list | add <name> <pcs> | del <name>] - Lists the webserver's audiences, or adds or removes one for a player owning the given PCs.",
+        "trace": "trace [start [<capacity>] | save <file> | stop [<file>]] - Records command, model, UI and webserver timings, saved as a Chrome trace."
     }
     VALID_CMDS = sorted(USAGES.keys()) # TODO: refer to Cmd class
+    COMMANDS = PrefixTrie(USAGES)
+    
+    # What each argument of each command can be completed with: a list of
+    # choices, NAME for the name of a combatant, or None for nothing.
+    NAME = object()
+    SPDS = map(str, xrange(1, 13))
+    KINDS = ["PC", "NPC"]
+    CHARS = ["S", "B", "E"]
+    DAMAGE_KINDS = ["N", "K"]
+    ARGS = {
+        "add": (None, SPDS, None, None, None, None, KINDS),
+        "addgroup": (None, None, SPDS, None, None, None, None, KINDS),
+        "del": (NAME,),
+        "lib": (["save", "find", "del", "open"],),
+        "abort": (NAME,),
+        "d": (NAME, CHARS),
+        "dmg": (NAME, CHARS),
+        "roll": (None, DAMAGE_KINDS),
+        "attack": (NAME, NAME, None, DAMAGE_KINDS),
+        "h": (NAME, CHARS),
+        "heal": (NAME, CHARS),
+        "stat": (NAME,),
+        "rec": (NAME, ["on", "off"]),
+        "chspd": (NAME, SPDS),
+        "record": (["stop"],),
+        "server": (["start", "stop"], None, ["thread", "process"]),
+        "trace": (["start", "save", "stop"],),
+        "players": (["show", "full", "hide"],),
+        "audience": (["list", "add", "del"], None, NAME),
+        "advance_until": (NAME, ["not"] + CONDITION_NAMES, CONDITION_NAMES),
+    }
+    
+    # Number of completions listed in hints.
+    MAX_LISTED = 8
     
     ## CONSTRUCTOR #############################################################
     
@@ -257,6 +616,10 @@ class MainCommand(cmd.Cmd):
         super(type(self), self).__init__()
         self._model = model
         self._window = window
+        self._last_error = None
+        self._library = None
+        self._depth = 0
+        self.recorder = None
     
     ## OTHER METHODS ###########################################################
     
@@ -264,60 +627,401 @@ class MainCommand(cmd.Cmd):
         # Override to prevent Cmd from repeating commands.
         pass
         
+    def onecmd(self, line):
+        # Commands run by scripts are not recorded separately, since
+        # replaying the script will run them again.
+        self._depth += 1
+        try:
+            with tracing.span(line.split(" ", 1)[0].strip() or "cmd", "cmd", line=line):
+                return cmd.Cmd.onecmd(self, line)
+        finally:
+            self._depth -= 1
+            if self._depth == 0 and self.recorder is not None \
+                    and line.split(" ", 1)[0].strip() != "record":
+                self.recorder.record(line, self._model.version)
+        
     def default(self, line):
-        self._win.disp_error("No such command {}.".format(line.split(" ")[0]))
+        self.error("No such command {}.".format(line.split(" ")[0]))
+        
+    def error(self, err_str):
+        """
+        Reports an error from the command being run, both to the window and
+        to :meth:`run_batch`.
+        """
+        self._last_error = err_str
+        self._window.disp_error(err_str)
+        
+    def info(self, info_str):
+        """
+        Shows the output of a command in place of the command hints.
+        """
+        self._window.cmd_hint = info_str
+        
+    @property
+    def library(self):
+        # The library is opened on first use, so that sessions which don't
+        # need it never touch the disk.
+        if self._library is None:
+            from library import CharacterLibrary
+            self._library = CharacterLibrary()
+        return self._library
+        
+    def run_batch(self, lines, refused=()):
+        """
+        Runs several command lines back to back as one batch, so that the
+        model notifies its listeners only once at the end. Returns a list
+        with one dictionary per line, giving the line and either
+        ``'ok': True`` or ``'ok': False`` together with an ``'error'``
+        message. A failing line does not stop the rest of the batch.
+        
+        Lines starting with any of the word lists in ``refused`` fail
+        without being run.
+        """
+        results = []
+        # The batch is recorded as a whole, once the model has moved on to
+        # its new version, rather than line by line.
+        self._depth += 1
+        try:
+            with self._model.batch():
+                for line in lines:
+                    self._last_error = None
+                    words = line.split()
+                    refusal = [command for command in refused if words[:len(command)] == command]
+                    if refusal:
+                        self._last_error = "The {} command can't be used here.".format(" ".join(refusal[0]))
+                    else:
+                        try:
+                            self.onecmd(line)
+                        except Exception as ex:
+                            self._last_error = str(ex) or type(ex).__name__
+                    if self._last_error is None:
+                        results.append({'cmd': line, 'ok': True})
+                    else:
+                        results.append({'cmd': line, 'ok': False, 'error': self._last_error})
+        finally:
+            self._depth -= 1
+        if self._depth == 0 and self.recorder is not None:
+            self.recorder.record_batch(lines, self._model.version)
+        return results
     
     ## COMMANDS ################################################################
     
+    ## COMPLETION ##
+    
+    def completenames(self, text, *ignored):
+        return self.COMMANDS.keys(text)
+        
+    def word_start(self, line):
+        """
+        Returns where the last word of a command line starts, counting quoted
+        spaces as part of the word.
+        """
+        start, quote = 0, None
+        for idx, char in enumerate(line):
+            if quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in "'\"":
+                quote = char
+            elif char == " ":
+                start = idx + 1
+        return start
+        
+    def complete_line(self, line):
+        """
+        Completes the last word of a command line, returning the longest
+        completion common to every match, and the first few matches.
+        """
+        args, text = self._split_line(line)
+        if not args:
+            return self.COMMANDS.extend_prefix(text), self.COMMANDS.keys(text)
+            
+        choices = self.ARGS.get(args[0], ())
+        choices = choices[len(args) - 1] if len(args) <= len(choices) else None
+        if choices is self.NAME:
+            # Complete the last of several comma-separated names, quoted as
+            # shlex and _split_targets expect.
+            text = self._unquote(text)
+            names = self._model.names
+            cut, quoted = 0, False
+            for idx, char in enumerate(text):
+                if char == '"':
+                    quoted = not quoted
+                elif char == "," and not quoted:
+                    cut = idx + 1
+            if names.count(text):
+                # The commas are part of a name.
+                cut = 0
+            head, text = text[:cut], text[cut:]
+            if text.startswith('"'):
+                text = text[1:]
+            return self._quote_target(head, names.extend_prefix(text), False), [
+                self._quote_target(head, name, True)
+                for name in names.keys(text, self.MAX_LISTED + 1)
+            ]
+        matches = [choice for choice in choices or () if choice.startswith(text)]
+        return os.path.commonprefix(matches) or text, matches
+        
+    def _split_line(self, line):
+        # Splits a command line into the words before the last one, as shlex
+        # reads them, and the last word as typed.
+        start = self.word_start(line)
+        try:
+            args = shlex.split(line[:start])
+        except ValueError:
+            args = line[:start].split()
+        return args, line[start:]
+        
+    def _unquote(self, word):
+        # Reads a word as shlex would, closing any quote left open.
+        for closing in ("", "'", '"'):
+            try:
+                words = shlex.split(word + closing)
+            except ValueError:
+                continue
+            return words[0] if words else ""
+        return word
+        
+    def _quote_target(self, head, name, done):
+        # Appends a name to a list of targets, double-quoting it if it holds
+        # commas, then single-quotes the whole word for shlex if need be.
+        # Quotes are left open until the name is complete.
+        if head and any(char in name for char in ',"'):
+            name = '"' + name.replace('"', '""') + ('"' if done else '')
+        word = head + name
+        if not any(char in word for char in " '\""):
+            return word
+        word = "'" + word.replace("'", "'\"'\"'")
+        return word + "'" if done else word
+        
+    def hint(self, line):
+        """
+        Returns the hint to show while the given command line is typed.
+        """
+        args, last = self._split_line(line)
+        if not args:
+            if last in self.COMMANDS:
+                return self.USAGES[last]
+            matches = self.COMMANDS.keys(last)
+            return "Available commands: " + ", ".join(matches or self.VALID_CMDS)
+        if args[0] not in self.COMMANDS:
+            return "Available commands: " + ", ".join(self.VALID_CMDS)
+            
+        hint = self.USAGES[args[0]]
+        choices = self.ARGS.get(args[0], ())
+        # The last target, unless the whole list could be the start of a name.
+        text = self._unquote(last)
+        if text and not self._model.names.count(text):
+            text = self._split_targets(text)[-1]
+        is_name = len(args) <= len(choices) and choices[len(args) - 1] is self.NAME
+        if is_name and text and text[0] != "@" and not any(char in text for char in "*?["):
+            # Show who the name refers to, as the command would resolve it.
+            cmb = self._model.get_combatant(text)
+            if cmb is not None:
+                name = cmb.name if isinstance(cmb, GroupMember) else cmb.display_name
+                return u"{} \u2192 {}".format(hint, to_unicode(name))
+            matches = self._model.names.keys(text, self.MAX_LISTED + 1)
+            if not matches:
+                return "{} No such combatant {}.".format(hint, text)
+            listed = ", ".join(matches[:self.MAX_LISTED])
+            if len(matches) > self.MAX_LISTED:
+                listed += ", ..."
+            return to_unicode("{} Matches: {}".format(hint, listed))
+        return hint
+        
     ## COMBATANT MANAGEMENT COMMANDS ##
     
     @shlexify
     def do_add(self, name, spd, dex, stun, body, end, kind="PC", status=""):
         self._model.add_combatant(Combatant(name, spd, dex, stun, body, end, kind=kind, status=status))
         
+    @shlexify
+    def do_addgroup(self, name, count, spd, dex, stun, body, end, kind="NPC", status=""):
+        self._model.add_combatant(CombatantGroup(name, count, spd, dex, stun, body, end, kind=kind, status=status))
+        
     @shlexify
     def do_del(self, name):
-        self._model.del_combatant(name)
+        try:
+            self._model.del_combatant(name)
+        except RuntimeError as ex:
+            self.error(str(ex))
+        
+    @shlexify
+    def do_import(self, filename):
+        from roster import load_roster
+        try:
+            combatants = load_roster(filename)
+        except (ValueError, IOError) as ex:
+            self.error("Import failed: {}".format(ex))
+            return
+        self._model.add_combatants(combatants)
+        
+    @shlexify
+    def do_lib(self, what, *args):
+        if what == "save" and len(args) >= 1:
+            cmb = self._model.get_combatant(args[0])
+            if cmb is None:
+                self.error("No such combatant {}.".format(args[0]))
+                return
+            self.library.save(cmb, tags=args[1:])
+            self.info("Saved {} to the library.".format(cmb.name))
+        elif what == "find":
+            names = self.library.find(args[0] if args else "")
+            self.info(", ".join(names) if names else "No matching templates.")
+        elif what == "del" and len(args) == 1:
+            if not self.library.delete(args[0]):
+                self.error("No such template {}.".format(args[0]))
+        elif what == "open" and len(args) == 1:
+            from library import CharacterLibrary
+            if self._library is not None:
+                self._library.close()
+            self._library = CharacterLibrary(args[0])
+        else:
+            self.error(self.USAGES["lib"])
+            
+    @shlexify
+    def do_spawn(self, name, count=1):
+        try:
+            combatants = self.library.spawn(
+                name, int(count),
+                taken=[cmb.name for cmb in self._model._combatants]
+            )
+        except KeyError:
+            self.error("No such template {}.".format(name))
+            return
+        self._model.add_combatants(combatants)
         
     @shlexify
     def do_stat(self, name, *args):
         stat = "" if len(args) == 0 else " ".join(args)
         with self._model.modify_combatant(name) as cmb:
             cmb.status = stat
+            self._model.log_event("status", cmb, status=stat)
+        
+    @shlexify
+    def do_rec(self, name, what=None):
+        cmb = self._model.get_combatant(name)
+        if cmb is None:
+            self.error("No such combatant {}.".format(name))
+            return
+        if what is None:
+            # Only showing REC changes nothing, so needs no reset.
+            self.info("{}: REC {}, recovery {}.".format(
+                cmb.name, cmb.rec, "on" if cmb.recovers else "off"
+            ))
+            return
+        if what not in ("on", "off"):
+            try:
+                rec = int(what)
+            except ValueError:
+                self.error(self.USAGES["rec"])
+                return
+            
+        with self._model.modify_combatant(name) as cmb:
+            if what in ("on", "off"):
+                cmb.recovers = what == "on"
+                self._model.log_event("rec", cmb, recovers=cmb.recovers)
+            else:
+                cmb.rec = rec
+                self._model.log_event("rec", cmb, rec=cmb.rec)
         
     ## SCRIPTING COMMANDS ##
         
     @shlexify
     def do_run(self, filename):
+        self._run_lines(self._read_script(filename))
+        
+    def _read_script(self, filename):
+        # Returns the commands in a script, leaving out comments.
         with open(filename, "r") as f:
-            for line in f:
-                if not line.strip().startswith("#"):
-                    self.onecmd(line)
+            return [line for line in f if not line.strip().startswith("#")]
+            
+    def _run_lines(self, lines):
+        for line in lines:
+            self.onecmd(line)
                     
+    @shlexify
+    def do_record(self, what):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if what != "stop":
+            from replay import SessionRecorder
+            self.recorder = SessionRecorder(what, self._model.version)
+            
     @shlexify
     def do_runpost12(self, filename):
-        self._model.on_post12 = lambda: self.do_run._undec(self, filename)
+        # Read the script now, so that fast-forwarding through many Turns
+        # doesn't read it again each time.
+        lines = self._read_script(filename)
+        self._model.on_post12 = lambda: self._run_lines(lines)
                     
     ## DAMAGE COMMANDS ##
                     
     @shlexify
-    def do_dmg(self, name, char, amt):
+    def do_dmg(self, targets, char, amt, falloff=0):
         ABBREVS = {"S": "stun", "B": "body", "E": "end"}
         amt = int(amt)
         char = char.upper()
         if char not in "SBE":
-            self._window.disp_error("Characteristic abbreviation {} not recognized.".format(char))
+            self.error("Characteristic abbreviation {} not recognized.".format(char))
             return
             
-        with self._model.modify_combatant(name) as cmb:
-            getattr(cmb, ABBREVS[char]).cur -= amt
+        self._apply_damage(targets, {ABBREVS[char]: amt}, int(falloff))
         
     do_d = do_dmg
     
+    def _split_targets(self, targets):
+        # Splits a comma-separated list of targets. A name containing commas
+        # can be given on its own, or double-quoted within the list, as in
+        # '"Smith, John",Agent*'.
+        if self._model.names.get(targets):
+            return [targets]
+        import csv
+        return next(csv.reader([targets], skipinitialspace=True))
+        
+    def _apply_damage(self, targets, amounts, falloff=0):
+        # Applies damage to several characteristics of every target named in
+        # a comma-separated list, returning whether it succeeded.
+        try:
+            self._model.apply_damage(self._split_targets(targets), amounts, falloff)
+        except RuntimeError as ex:
+            self.error(str(ex))
+            return False
+        return True
+    
     @shlexify
-    def do_heal(self, name, char, amt):
+    def do_roll(self, dice, kind="N", hits=1):
+        from dice import roll_damage
+        try:
+            self.info(str(roll_damage(dice, kind, hits)))
+        except ValueError as ex:
+            self.error(str(ex))
+            
+    @shlexify
+    def do_attack(self, attacker, target, dice, kind="N", hits=None):
+        from dice import roll_damage
+        atk = self._model.get_combatant(attacker)
+        if atk is None:
+            self.error("No such combatant {}.".format(attacker))
+            return
+            
+        # A group attacks with every member at once, unless told otherwise.
+        if hits is None:
+            hits = atk.count if isinstance(atk, CombatantGroup) else 1
+        try:
+            result = roll_damage(dice, kind, hits)
+        except ValueError as ex:
+            self.error(str(ex))
+            return
+            
+        if self._apply_damage(target, {"stun": result.total_stun, "body": result.total_body}):
+            self.info("{} -> {}: {}".format(atk.name, target, result))
+    
+    @shlexify
+    def do_heal(self, targets, char, amt, falloff=0):
         # Dirty hack to bypass shlexification.
-        self.do_dmg._undec(self, name, char, -int(amt))
+        self.do_dmg._undec(self, targets, char, -int(amt), falloff)
         
     do_h = do_heal
                   
@@ -333,12 +1037,56 @@ class MainCommand(cmd.Cmd):
         seg = int(seg)
         self._model.skip_to(seg)
     
+    @shlexify
+    def do_advance(self, turns=1):
+        try:
+            turns = int(turns)
+        except ValueError:
+            turns = 0
+        if turns < 1:
+            self.error(self.USAGES["advance"])
+            return
+        self._model.advance(turns)
+        
+    @shlexify
+    def do_advance_until(self, targets, *args):
+        args = list(args)
+        negate = bool(args) and args[0] == "not"
+        if negate:
+            args.pop(0)
+        if not args or args[0] not in CONDITION_NAMES or len(args) > 2:
+            self.error(self.USAGES["advance_until"])
+            return
+        condition = args[0]
+        try:
+            max_turns = int(args[1]) if len(args) > 1 else 1000
+        except ValueError:
+            max_turns = 0
+        if max_turns < 1:
+            self.error(self.USAGES["advance_until"])
+            return
+        
+        try:
+            cmbs = self._model.find_combatants(self._split_targets(targets))
+        except RuntimeError as ex:
+            self.error(str(ex))
+            return
+        def until(model):
+            held = model.with_condition(condition)
+            return all((cmb in held) != negate for cmb in cmbs)
+            
+        advanced = self._model.advance_until(until, max_turns)
+        if advanced is None:
+            self.error("Still not there after {} Turns.".format(max_turns))
+        else:
+            self.info("Advanced {} Turns.".format(advanced))
+        
     @shlexify
     def do_abort(self, name):
         try:
             self._model.abort_phase(name)
         except RuntimeError as ex:
-            self._window.disp_error(str(ex))
+            self.error(str(ex))
         
     @shlexify
     def do_chspd(self, name, new_spd):
@@ -348,24 +1096,109 @@ class MainCommand(cmd.Cmd):
     ## SERVER COMMANDS ##
             
     @shlexify
-    def do_server(self, what, port=None):
+    def do_server(self, what, port=None, mode=None):
         if what == "start":
             extra_args = {}
+            # Allow the port to be left out before the mode.
+            if port in ("thread", "process"):
+                port, mode = None, port
             if port is not None:
                 extra_args['port'] = int(port)
+            if mode is not None:
+                extra_args['mode'] = mode
             self._window.start_server(**extra_args)
         if what == "stop":
             self._window.stop_server()
+            
+    @shlexify
+    def do_players(self, what="show"):
+        if what in ("show", "full"):
+            self._window.show_players(full_screen=what == "full")
+        elif what == "hide":
+            self._window.hide_players()
+        else:
+            self.error(self.USAGES["players"])
+            
+    @shlexify
+    def do_audience(self, what="list", name=None, targets=None):
+        if name is not None:
+            name = to_unicode(name)
+        if what == "list":
+            self.info(u"Audiences: " + u"; ".join(
+                u"{} ({})".format(audience.name, to_unicode(audience.description))
+                for audience in self._window.audiences
+            ))
+        elif what == "add" and targets is not None:
+            from audiences import owner
+            from urllib import quote
+            try:
+                owned = [
+                    cmb.name
+                    for cmb in self._model.find_combatants(self._split_targets(targets))
+                    if cmb.kind == "PC"
+                ]
+                if not owned:
+                    raise RuntimeError("No PCs among {}.".format(targets))
+                self._window.audiences.add(owner(name, owned))
+            except RuntimeError as ex:
+                # Messages about audiences are unicode, so not str(ex).
+                self.error(ex.args[0])
+                return
+            self.info(u"Audience {} sees {} in full at /api/view/{}.".format(
+                name, u", ".join(to_unicode(pc_name) for pc_name in owned),
+                quote(name.encode('utf-8'))
+            ))
+        elif what == "del" and name is not None:
+            try:
+                self._window.audiences.remove(name)
+            except RuntimeError as ex:
+                self.error(ex.args[0])
+        else:
+            self.error(self.USAGES["audience"])
+            
+    ## DIAGNOSTIC COMMANDS ##
+            
+    @shlexify
+    def do_trace(self, what, arg=None):
+        if what == "start":
+            try:
+                capacity = int(arg) if arg is not None else tracing.DEFAULT_CAPACITY
+            except ValueError:
+                capacity = 0
+            if capacity <= 0:
+                self.error(self.USAGES["trace"])
+                return
+            tracing.start(capacity)
+            self.info("Tracing.")
+        elif what in ("save", "stop"):
+            if not tracing.active():
+                self.error("Not tracing.")
+                return
+            if arg is not None:
+                tracing.save(arg)
+                self.info("Trace saved to {}.".format(arg))
+            elif what == "save":
+                self.error(self.USAGES["trace"])
+                return
+            if what == "stop":
+                tracing.stop()
+        else:
+            self.error(self.USAGES["trace"])
    
 ## MAIN ########################################################################
    
 def main():
+    startup_profile.mark("imports")
     app = QtGui.QApplication(sys.argv)
+    startup_profile.mark("QApplication")
     main_win = MainWindow()
+    startup_profile.mark("MainWindow")
     app.lastWindowClosed.connect(main_win.stop_server)
     main_win.show()
+    if startup_profile.active():
+        # Report once the window has been shown and the event loop is idle.
+        QtCore.QTimer.singleShot(0, lambda: startup_profile.report("first paint"))
     sys.exit(app.exec_())
     
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# player_window.py: Player-facing display of the PCs, for a second screen.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+from PySide import QtCore, QtGui
+
+import tracing
+
+## CLASSES #####################################################################
+
+class PlayerTableModel(QtCore.QAbstractTableModel):
+    """
+    Table of the PCs in a :class:`SpeedChartModel`, highest DEX first. Rows
+    are only re-read from the underlying model when :meth:`update` is
+    called, and cells are taken from the underlying model's cache of
+    formatted cells, so showing this table costs next to nothing per
+    change to the combat.
+    """
+    
+    # Columns of the underlying model shown to players: Name, STUN, BODY,
+    # END and Status.
+    COLUMNS = [0, 15, 16, 17, 18]
+    
+    CURRENT_BRUSH = QtGui.QBrush(QtGui.QColor(255, 230, 150))
+    
+    def __init__(self, source, parent=None):
+        super(PlayerTableModel, self).__init__(parent)
+        self._source = source
+        self._rows = []
+        
+    def update(self):
+        self.beginResetModel()
+        self._rows = sorted(
+            self._source.of_kind("PC"),
+            key=lambda cmb: (-cmb.dex, cmb.name)
+        )
+        self.endResetModel()
+        
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return len(self._rows)
+        
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.COLUMNS)
+        
+    def data(self, index, role):
+        if not index.isValid() or not 0 <= index.row() < len(self._rows):
+            return None
+        cmb = self._rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return self._source.cell(cmb, self.COLUMNS[index.column()])
+        elif role == QtCore.Qt.BackgroundRole:
+            if cmb is self._source.current_combatant:
+                return self.CURRENT_BRUSH
+        return None
+        
+    def headerData(self, section, orientation, role):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self._source.HEADER_NAMES[self.COLUMNS[section]]
+        return None
+
+class PlayerWindow(QtGui.QWidget):
+    """
+    Top-level window showing the PCs and the current phase in a large font,
+    meant for a screen facing the players. It shows the same model as the
+    GM's window, but catches up with it on its own, slower, schedule.
+    """
+    
+    ## CONSTANTS ###############################################################
+    
+    # Minimum time, in milliseconds, between two updates of this window.
+    UPDATE_INTERVAL = 250
+    
+    FONT_SIZE = 28
+    
+    ## CONSTRUCTOR #############################################################
+    
+    def __init__(self, model, parent=None):
+        super(PlayerWindow, self).__init__(parent, QtCore.Qt.Window)
+        self.setWindowTitle("hero_init - Players")
+        font = self.font()
+        font.setPointSize(self.FONT_SIZE)
+        self.setFont(font)
+        
+        self._model = model
+        
+        self.lbl_phase = QtGui.QLabel(self)
+        self.lbl_phase.setAlignment(QtCore.Qt.AlignCenter)
+        
+        self.table_model = PlayerTableModel(model, self)
+        self.tbl_pcs = QtGui.QTableView(self)
+        self.tbl_pcs.setModel(self.table_model)
+        self.tbl_pcs.verticalHeader().hide()
+        self.tbl_pcs.horizontalHeader().setResizeMode(QtGui.QHeaderView.Stretch)
+        self.tbl_pcs.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self.tbl_pcs.setSelectionMode(QtGui.QAbstractItemView.NoSelection)
+        self.tbl_pcs.setFocusPolicy(QtCore.Qt.NoFocus)
+        
+        layout = QtGui.QVBoxLayout(self)
+        layout.addWidget(self.lbl_phase)
+        layout.addWidget(self.tbl_pcs)
+        
+        # Like the GM's window, changes only schedule an update.
+        self._update_timer = QtCore.QTimer(self)
+        self._update_timer.setSingleShot(True)
+        self._update_timer.setInterval(self.UPDATE_INTERVAL)
+        self._update_timer.timeout.connect(self.refresh)
+        model.dataChanged.connect(self.on_model_change)
+        model.modelReset.connect(self.on_model_change)
+        model.rowsInserted.connect(self.on_model_change)
+        
+        self.refresh()
+        
+    ## METHODS #################################################################
+    
+    def show_on_second_screen(self):
+        """
+        Shows this window full-screen, on the second screen if there is one.
+        """
+        desktop = QtGui.QApplication.desktop()
+        screen = 1 if desktop.screenCount() > 1 else 0
+        self.move(desktop.screenGeometry(screen).topLeft())
+        self.showFullScreen()
+        
+    @tracing.traced("player refresh", "qt")
+    def refresh(self):
+        model = self._model
+        cmb = model.current_combatant
+        if model.segment == 0:
+            phase = u"Post-Segment 12"
+        else:
+            phase = u"Segment {}".format(model.segment)
+            if cmb is not None:
+                # As on the players' phones, NPCs aren't named.
+                name = cmb.name if cmb.kind == "PC" else "NPC"
+                phase += u": " + (name.decode('utf-8') if isinstance(name, str) else name)
+        self.lbl_phase.setText(u"Turn {} \u00b7 {}".format(model.turn, phase))
+        self.table_model.update()
+        
+    def showEvent(self, event):
+        # Catch up with anything that happened while hidden.
+        self.refresh()
+        super(PlayerWindow, self).showEvent(event)
+        
+    ## EVENTS ##################################################################
+    
+    def on_model_change(self, *args):
+        # Nobody sees a hidden window, so don't bother updating it.
+        if self.isVisible() and not self._update_timer.isActive():
+            self._update_timer.start()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# replay.py: Recording GM sessions, and replaying them without a window.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Replays a recorded session as fast as possible, without a window, and
+reports timings and a hash of the final state.
+
+Usage:
+    python replay.py <recording.jsonl>
+"""
+
+## IMPORTS #####################################################################
+
+import os
+import sys
+import json
+import time
+import struct
+import hashlib
+
+import dice
+
+## CLASSES #####################################################################
+
+class SessionRecorder(object):
+    """
+    Writes each command run at the top level of a :class:`MainCommand`, one
+    JSON object per line, giving the time since recording started
+    (``'t'``), the command line (``'cmd'``), and how far the model version
+    has moved on since recording started, once the command has run
+    (``'version'``). Batches of commands, as run by
+    :meth:`MainCommand.run_batch`, are recorded as one line listing every
+    command (``'cmds'``).
+    
+    The first line instead records the seed given to the dice, so that
+    replays roll the same damage.
+    """
+    def __init__(self, filename, version=0):
+        self._file = open(filename, "w")
+        self._start = time.time()
+        self._start_version = version
+        
+        dice_seed = struct.unpack("<I", os.urandom(4))[0]
+        dice.seed(dice_seed)
+        self._file.write(json.dumps({'seed': dice_seed}) + "\n")
+        
+    def record(self, line, version):
+        self._write({'cmd': line.rstrip("\n")}, version)
+        
+    def record_batch(self, lines, version):
+        self._write({'cmds': [line.rstrip("\n") for line in lines]}, version)
+        
+    def _write(self, entry, version):
+        entry['t'] = round(time.time() - self._start, 6)
+        entry['version'] = version - self._start_version
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        
+    def close(self):
+        self._file.close()
+        
+class HeadlessWindow(object):
+    """
+    Takes the place of the main window for a :class:`MainCommand` run
+    without a GUI. Errors and command output are kept rather than shown,
+    and neither the embedded server nor the player window is ever started.
+    """
+    def __init__(self):
+        self.errors = []
+        self.cmd_hint = ""
+        from audiences import Audiences
+        self.audiences = Audiences()
+        
+    def disp_error(self, err_str):
+        self.errors.append(err_str)
+        
+    def start_server(self, *args, **kwargs):
+        pass
+        
+    def stop_server(self):
+        pass
+        
+    def show_players(self, full_screen=False):
+        pass
+        
+    def hide_players(self):
+        pass
+        
+## FUNCTIONS ###################################################################
+
+def state_hash(model):
+    """
+    Returns a hash of everything in the model that affects play: the current
+    time, the current combatant and every characteristic, status and segment
+    of every combatant, in roster order.
+    """
+    state = {
+        'now': [model.turn, model.segment],
+        'current': model.current_combatant.name if model.current_combatant is not None else None,
+        'combatants': [
+            [
+                cmb.name, cmb.kind, cmb.spd, cmb.dex, cmb.rec, cmb.status,
+                [cmb.stun.cur, cmb.stun.max],
+                [cmb.body.cur, cmb.body.max],
+                [cmb.end.cur, cmb.end.max],
+                list(cmb._segment)
+            ]
+            for cmb in model._combatants
+        ]
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+    
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = int(round((len(sorted_values) - 1) * pct / 100.0))
+    return sorted_values[idx]
+
+def replay(filename):
+    """
+    Runs every command of a recording through a fresh model and command
+    interpreter, as fast as possible. Returns a dictionary with the total
+    time, the time taken by each command, the commands whose resulting model
+    version differs from the recording, any errors reported, and the hash of
+    the final state.
+    """
+    # Imported here, so that recording doesn't depend on the GUI modules.
+    from PySide import QtCore
+    from combat_model import SpeedChartModel
+    from main_window import MainCommand
+    
+    _ = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+    
+    with open(filename, "r") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if entries and 'seed' in entries[0]:
+        dice.seed(entries.pop(0)['seed'])
+        
+    model = SpeedChartModel()
+    window = HeadlessWindow()
+    interp = MainCommand(model, window)
+    
+    latencies = []
+    mismatches = []
+    start_version = model.version
+    start = time.time()
+    for entry in entries:
+        cmd_start = time.time()
+        if 'cmds' in entry:
+            line = [cmd.encode('utf-8') for cmd in entry['cmds']]
+            interp.run_batch(line)
+        else:
+            line = entry['cmd'].encode('utf-8')
+            interp.onecmd(line)
+        latencies.append(time.time() - cmd_start)
+        version = model.version - start_version
+        if version != entry.get('version', version):
+            mismatches.append((line, entry['version'], version))
+    total = time.time() - start
+    
+    return {
+        'commands': len(entries),
+        'total': total,
+        'latencies': latencies,
+        'version_mismatches': mismatches,
+        'errors': window.errors,
+        'state_hash': state_hash(model)
+    }
+    
+def print_report(report, out=sys.stdout):
+    latencies = sorted(report['latencies'])
+    print >>out, "Commands:       {}".format(report['commands'])
+    print >>out, "Total time:     {:.3f} ms".format(1000 * report['total'])
+    for pct in (50, 90, 99, 100):
+        print >>out, "Latency p{:<3}:  {:.3f} ms".format(pct, 1000 * percentile(latencies, pct))
+    print >>out, "Errors:         {}".format(len(report['errors']))
+    print >>out, "Version diffs:  {}".format(len(report['version_mismatches']))
+    for line, recorded, replayed in report['version_mismatches'][:10]:
+        print >>out, "    {!r}: recorded {}, replayed {}".format(line, recorded, replayed)
+    print >>out, "Final state:    {}".format(report['state_hash'])
+    
+## MAIN ########################################################################
+
+def main(argv):
+    if len(argv) != 2:
+        print >>sys.stderr, __doc__.strip()
+        return 2
+    print_report(replay(argv[1]))
+    return 0
+    
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# roster.py: Reading combatant rosters from CSV and JSON files.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import os
+import csv
+import json
+
+from combat_model import Combatant, Characteristic, COMBATANT_KINDS
+
+## CONSTANTS ###################################################################
+
+ROSTER_FIELDS = ("name", "spd", "dex", "stun", "body", "end", "kind", "status", "rec")
+REQUIRED_FIELDS = ROSTER_FIELDS[:6]
+
+# Number of row errors quoted in the message of a RosterError.
+MAX_REPORTED_ERRORS = 5
+
+## CLASSES #####################################################################
+
+class RosterError(ValueError):
+    """
+    Raised when one or more rows of a roster are invalid. The ``errors``
+    attribute lists every problem found as ``(row, message)`` pairs, with
+    rows counted from 1.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        msg = "; ".join(
+            "row {}: {}".format(row, err)
+            for row, err in errors[:MAX_REPORTED_ERRORS]
+        )
+        if len(errors) > MAX_REPORTED_ERRORS:
+            msg += " (and {} more)".format(len(errors) - MAX_REPORTED_ERRORS)
+        super(RosterError, self).__init__(msg)
+
+## FUNCTIONS ###################################################################
+
+def _text(value):
+    # The csv module yields byte strings while json yields unicode; settle on
+    # UTF-8 byte strings, as used by the rest of hero_init.
+    if isinstance(value, unicode):
+        return value.encode('utf-8').strip()
+    return str(value).strip()
+
+def iter_records(f, fmt):
+    """
+    Yields each record of a roster file as a dictionary, reading the file
+    one row at a time where the format allows it. ``fmt`` is one of
+    ``"csv"``, ``"json"`` (a list of objects) or ``"jsonl"`` (one object
+    per line). Records that cannot be decoded are yielded as the exception
+    raised while decoding them.
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(f):
+            yield row
+            
+    elif fmt == "jsonl":
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as ex:
+                yield ex
+                
+    elif fmt == "json":
+        # The standard library can't stream a JSON array, so this is the
+        # one format that is read in full.
+        records = json.load(f)
+        if not isinstance(records, list):
+            raise ValueError("expected a list of combatants")
+        for record in records:
+            yield record
+            
+    else:
+        raise ValueError("Unknown roster format {}.".format(fmt))
+        
+def make_combatant(record):
+    """
+    Validates one roster record and returns the corresponding
+    :class:`~combat_model.Combatant`, or raises :class:`ValueError`
+    describing what is wrong with the record.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("expected an object with fields {}".format(", ".join(ROSTER_FIELDS)))
+        
+    # Field names are case-insensitive, and empty cells count as missing.
+    fields = dict(
+        (_text(key).lower(), _text(value))
+        for key, value in record.iteritems()
+        if key is not None and value is not None and _text(value) != ""
+    )
+    missing = [field for field in REQUIRED_FIELDS if field not in fields]
+    if missing:
+        raise ValueError("missing {}".format(", ".join(missing)))
+        
+    for field in ("spd", "dex", "rec"):
+        if field not in fields:
+            continue
+        try:
+            int(fields[field])
+        except ValueError:
+            raise ValueError("{} must be an integer, not {!r}".format(
+                field.upper(), fields[field]
+            ))
+    if not 0 <= int(fields["spd"]) <= 12:
+        raise ValueError("SPD must be between 0 and 12, not {}".format(fields["spd"]))
+    
+    for field in ("stun", "body", "end"):
+        try:
+            Characteristic(fields[field])
+        except ValueError:
+            raise ValueError("{} must be <cur>/<max> or an integer, not {!r}".format(
+                field.upper(), fields[field]
+            ))
+            
+    kind = fields.get("kind", "PC").upper()
+    if kind not in COMBATANT_KINDS:
+        raise ValueError("kind must be one of {}, not {!r}".format(
+            ", ".join(COMBATANT_KINDS), kind
+        ))
+        
+    return Combatant(
+        fields["name"], fields["spd"], fields["dex"],
+        fields["stun"], fields["body"], fields["end"],
+        status=fields.get("status", ""), kind=kind, rec=fields.get("rec", 0)
+    )
+    
+def load_roster(filename, fmt=None):
+    """
+    Reads a roster from ``filename`` and returns the list of combatants it
+    describes. The format is guessed from the file extension (``.json``,
+    ``.jsonl``, anything else being read as CSV) unless ``fmt`` is given.
+    
+    Every row is validated before anything is returned; if any row is
+    invalid, a :class:`RosterError` listing all of the problems is raised
+    instead. A :class:`ValueError` is raised if the file can't be parsed at
+    all.
+    """
+    if fmt is None:
+        ext = os.path.splitext(filename)[1].lower()
+        fmt = {".json": "json", ".jsonl": "jsonl"}.get(ext, "csv")
+        
+    combatants = []
+    errors = []
+    with open(filename, "rb" if fmt == "csv" else "r") as f:
+        try:
+            for row, record in enumerate(iter_records(f, fmt), 1):
+                try:
+                    if isinstance(record, Exception):
+                        raise record
+                    combatants.append(make_combatant(record))
+                except ValueError as ex:
+                    errors.append((row, str(ex)))
+        except (ValueError, csv.Error) as ex:
+            # The file as a whole couldn't be parsed.
+            raise ValueError("Could not read roster {}: {}".format(filename, ex))
+                
+    if errors:
+        raise RosterError(errors)
+    return combatants
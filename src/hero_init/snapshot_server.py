@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# snapshot_server.py: Player server running in its own process, fed from a
+#     memory-mapped snapshot of the PCs written by the GUI process.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import os
+import sys
+import json
+import mmap
+import time
+import socket
+import struct
+import tempfile
+import threading
+import subprocess
+
+## CONSTANTS ###################################################################
+
+# The snapshot file starts with a header, followed by the payload:
+#     magic   - identifies the file,
+#     seq     - odd while the writer is updating the payload, even otherwise,
+#     version - incremented each time a new payload is written,
+#     length  - length of the payload in bytes.
+HEADER = struct.Struct("<4sQQI")
+MAGIC = "HIPC"
+SEQ_SLICE = slice(4, 12)
+
+# Printed by the server process once it is listening.
+READY = "ready"
+
+# Room left for the payload. A PC takes a few hundred bytes.
+DEFAULT_CAPACITY = 1 << 20
+
+## CLASSES #####################################################################
+
+class SnapshotWriter(object):
+    """
+    Publishes snapshots of the PCs through a memory-mapped file, for a
+    :class:`SnapshotReader` in another process. Readers never block the
+    writer; instead, they retry if they catch a snapshot mid-update.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        fd, self._path = tempfile.mkstemp(prefix="hero_init-", suffix=".snapshot")
+        self._file = os.fdopen(fd, "r+b")
+        self._file.truncate(HEADER.size + capacity)
+        self._capacity = capacity
+        self._map = mmap.mmap(self._file.fileno(), HEADER.size + capacity)
+        self._seq = 0
+        self._version = 0
+        self._payload = None
+        self.write("[]")
+        
+    @property
+    def path(self):
+        return self._path
+        
+    @property
+    def version(self):
+        return self._version
+        
+    def write(self, payload):
+        """
+        Publishes a new payload, unless it is the same as the last one.
+        """
+        if payload == self._payload:
+            return
+        if len(payload) > self._capacity:
+            raise ValueError("Snapshot of {} bytes is too large.".format(len(payload)))
+        
+        # Mark the snapshot as being updated, copy the payload in and fill in
+        # the rest of the header, then publish it all by making seq even
+        # again. Readers check seq before and after reading, so the new seq
+        # must be written last, on its own.
+        self._seq += 1
+        self._map[SEQ_SLICE] = struct.pack("<Q", self._seq)
+        self._map[HEADER.size:HEADER.size + len(payload)] = payload
+        self._version += 1
+        header = HEADER.pack(MAGIC, self._seq + 1, self._version, len(payload))
+        self._map[:SEQ_SLICE.start] = header[:SEQ_SLICE.start]
+        self._map[SEQ_SLICE.stop:HEADER.size] = header[SEQ_SLICE.stop:]
+        self._seq += 1
+        self._map[SEQ_SLICE] = header[SEQ_SLICE]
+        self._payload = payload
+        
+    def close(self):
+        self._map.close()
+        self._file.close()
+        os.remove(self._path)
+        
+class SnapshotReader(object):
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._parsed = (None, {})
+        
+    def read(self):
+        """
+        Returns the version and payload of the latest complete snapshot.
+        """
+        while True:
+            magic, seq, version, length = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise IOError("Not a hero_init snapshot.")
+            if seq % 2 == 0:
+                payload = self._map[HEADER.size:HEADER.size + length]
+                if HEADER.unpack_from(self._map, 0)[1] == seq:
+                    return version, payload
+            time.sleep(0)
+            
+    def pcs_by_name(self):
+        """
+        Returns a dictionary from PC names to their serialized state, parsed
+        once per snapshot version.
+        """
+        version, payload = self.read()
+        parsed_version, by_name = self._parsed
+        if parsed_version != version:
+            by_name = dict(
+                (pc['name'], json.dumps(pc))
+                for pc in json.loads(payload)
+            )
+            self._parsed = (version, by_name)
+        return by_name
+        
+## FUNCTIONS ###################################################################
+
+def make_snapshot_handler(reader):
+    # Imported here, so that the GUI process can use SnapshotWriter without
+    # pulling in the server stack.
+    from http_handler import make_http_handler, PCDeltas, parse_since
+    
+    deltas = PCDeltas()
+    
+    class SnapshotHTTPHandler(make_http_handler(None)):
+        def send_api(self, api_path):
+            since = parse_since(api_path)
+            if api_path.startswith("/pcs?") and since is not None:
+                version, payload = reader.read()
+                self.send_json(json.dumps(deltas.payload(
+                    version, lambda: json.loads(payload), since=since
+                )))
+            elif api_path == "/pcs":
+                # The snapshot is exactly what this route serves.
+                self.send_json(reader.read()[1])
+            elif api_path.startswith("/pcs/"):
+                self.send_json(reader.pcs_by_name().get(
+                    api_path.partition("/pcs/")[2], "null"
+                ))
+            else:
+                self.send_body(404)
+                
+    return SnapshotHTTPHandler
+    
+def launch(snapshot_path, port):
+    """
+    Starts the player server in a new process, serving the snapshot at
+    ``snapshot_path`` on ``port``, and waits for it to be listening. The
+    server exits on its own if the returned process's stdin is closed,
+    which includes the GUI exiting.
+    
+    Raises :class:`RuntimeError` if the server couldn't start, for instance
+    because the port is already in use.
+    """
+    if getattr(sys, 'frozen', False):
+        # Packaged apps have no script to run, so run the app itself, whose
+        # __main__ hands over to main() below.
+        args = [os.environ.get('EXECUTABLEPATH', sys.executable), "--snapshot-server"]
+    else:
+        args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot_server.py")]
+    proc = subprocess.Popen(
+        args + [snapshot_path, str(port)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    status = proc.stdout.readline().strip()
+    if status != READY:
+        proc.stdin.close()
+        proc.wait()
+        raise RuntimeError(status or "Server exited before it started.")
+    return proc
+    
+def _exit_with_parent():
+    # Blocks until the parent closes our stdin, then exits.
+    sys.stdin.read()
+    os._exit(0)
+    
+## MAIN ########################################################################
+
+def main(argv):
+    snapshot_path, port = argv[1], int(argv[2])
+    watcher = threading.Thread(target=_exit_with_parent)
+    watcher.daemon = True
+    watcher.start()
+    
+    # Tell launch() whether the port could be bound.
+    from http_handler import PooledHTTPServer
+    try:
+        server = PooledHTTPServer(
+            ('', port), make_snapshot_handler(SnapshotReader(snapshot_path))
+        )
+    except (socket.error, IOError) as ex:
+        print str(ex)
+        sys.stdout.flush()
+        os._exit(1)
+    print READY
+    sys.stdout.flush()
+    server.serve_forever()
+    
+if __name__ == "__main__":
+    main(sys.argv)
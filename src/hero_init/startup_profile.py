@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# startup_profile.py: Measures where the time goes while hero_init starts.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+# Only the bare minimum, since everything imported here is imported before
+# timing starts.
+import sys
+import time
+import __builtin__
+
+## GLOBALS #####################################################################
+
+_start = None
+_original_import = None
+# Time spent in imports of other modules, for each import in progress.
+_nested = []
+# (module name, seconds including the modules it imported, seconds excluding
+# them), for each import that loaded something new.
+_imports = []
+# (step name, seconds since starting), in order.
+_marks = []
+
+## FUNCTIONS ###################################################################
+
+def install():
+    """
+    Starts timing startup, including every module imported from now on.
+    """
+    global _start, _original_import
+    if _start is not None:
+        return
+    _start = time.time()
+    _original_import = __builtin__.__import__
+    __builtin__.__import__ = _timed_import
+    
+def active():
+    return _start is not None
+    
+def _timed_import(name, *args, **kwargs):
+    n_modules = len(sys.modules)
+    _nested.append(0.0)
+    started = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - started
+        nested = _nested.pop()
+        if _nested:
+            _nested[-1] += elapsed
+        if len(sys.modules) > n_modules:
+            _imports.append((name, elapsed, elapsed - nested))
+            
+def mark(step):
+    """
+    Records that a step of startup has just finished. Does nothing unless
+    :func:`install` was called.
+    """
+    if _start is not None:
+        _marks.append((step, time.time() - _start))
+        
+def report(step=None, n_slowest=20, out=None):
+    """
+    Stops timing, and prints how long each step of startup took, followed
+    by the slowest imports.
+    """
+    global _start
+    if _start is None:
+        return
+    if step is not None:
+        mark(step)
+    total = time.time() - _start
+    __builtin__.__import__ = _original_import
+    _start = None
+    out = out if out is not None else sys.stderr
+    
+    print >>out, "Startup profile (ms):"
+    last = 0.0
+    for name, at in _marks:
+        print >>out, "  {:<24} {:8.1f}".format(name, 1000 * (at - last))
+        last = at
+    print >>out, "  {:<24} {:8.1f}".format("total", 1000 * total)
+    
+    print >>out, "Slowest imports (ms, alone / with what they import):"
+    for name, elapsed, alone in sorted(_imports, key=lambda imp: -imp[2])[:n_slowest]:
+        print >>out, "  {:8.1f} {:8.1f}  {}".format(1000 * alone, 1000 * elapsed, name)
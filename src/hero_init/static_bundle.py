@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# static_bundle.py: Serves the player page from one archive or a directory.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import os
+import sys
+import mmap
+import struct
+import zipfile
+import mimetypes
+import threading
+
+## CONSTANTS ###################################################################
+
+# Length of a zip local file header, and the offset within it of the file
+# name and extra field lengths.
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER_NAMES = struct.Struct("<HH")
+LOCAL_HEADER_NAMES_OFFSET = 26
+
+BUNDLE_NAME = "_static.zip"
+
+## CLASSES #####################################################################
+
+class StaticBundle(object):
+    """
+    Static files held in one zip archive, which is opened and memory-mapped
+    once. Stored entries are served as buffers over the mapping, without
+    copying them; any compressed entries are inflated once, on open.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        # Maps each path in the archive to its contents and MIME type.
+        self._files = {}
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            archive = zipfile.ZipFile(f)
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                if info.compress_type == zipfile.ZIP_STORED:
+                    start = self._data_offset(info)
+                    contents = buffer(self._mmap, start, info.file_size)
+                else:
+                    contents = archive.read(info)
+                self._files[info.filename] = (
+                    contents, mimetypes.guess_type(info.filename)[0]
+                )
+                
+    def _data_offset(self, info):
+        # The central directory doesn't say where an entry's data starts,
+        # so skip over its local header, whose name and extra field may
+        # differ in length from those in the central directory.
+        header = info.header_offset
+        name_len, extra_len = LOCAL_HEADER_NAMES.unpack_from(
+            self._mmap, header + LOCAL_HEADER_NAMES_OFFSET
+        )
+        return header + LOCAL_HEADER_SIZE + name_len + extra_len
+        
+    def get(self, path):
+        """
+        Returns the contents and MIME type of the file at ``path``, or
+        ``None`` if there is no such file.
+        """
+        return self._files.get(path)
+        
+    def paths(self):
+        return sorted(self._files)
+        
+class StaticDirectory(object):
+    """
+    Static files read from a directory on each request, so that changes to
+    them show up straight away during development.
+    """
+    
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        
+    def get(self, path):
+        full_path = os.path.realpath(os.path.join(self.path, path))
+        # Don't serve anything outside of the directory.
+        if not full_path.startswith(self.path + os.sep):
+            return None
+        try:
+            with open(full_path, 'rb') as f:
+                return f.read(), mimetypes.guess_type(path)[0]
+        except IOError:
+            return None
+            
+    def paths(self):
+        return sorted(
+            os.path.relpath(os.path.join(dirpath, fname), self.path).replace(os.sep, '/')
+            for dirpath, dirnames, fnames in os.walk(self.path)
+            for fname in fnames
+        )
+        
+## FUNCTIONS ###################################################################
+
+def resource_dir():
+    """
+    Returns the directory holding ``_static`` and, in packaged builds,
+    ``_static.zip``.
+    """
+    # py2app sets RESOURCEPATH, and copies hero_init into it.
+    if 'RESOURCEPATH' in os.environ:
+        return os.path.join(os.environ['RESOURCEPATH'], 'hero_init')
+    return os.path.dirname(os.path.abspath(__file__))
+    
+_static = []
+_static_lock = threading.Lock()
+
+def packaged():
+    """
+    Returns True when running from a packaged build, rather than from the
+    source tree.
+    """
+    return bool(getattr(sys, 'frozen', False)) or 'RESOURCEPATH' in os.environ
+    
+def static_files():
+    """
+    Returns the static files served to players: in packaged builds, the
+    bundle archive if there is one, and otherwise the ``_static``
+    directory. Runs from the source tree always use the directory, even if
+    packaging has left an archive next to it, so that edits show up.
+    """
+    if not _static:
+        with _static_lock:
+            if not _static:
+                base = resource_dir()
+                bundle = os.path.join(base, BUNDLE_NAME)
+                if packaged() and os.path.exists(bundle):
+                    _static.append(StaticBundle(bundle))
+                else:
+                    _static.append(StaticDirectory(os.path.join(base, "_static")))
+    return _static[0]
+    
+def build_bundle(static_dir, out_path):
+    """
+    Writes every file under ``static_dir`` into the archive at ``out_path``.
+    Entries are stored uncompressed, so that they can be served straight
+    from the mapping.
+    """
+    files = StaticDirectory(static_dir)
+    with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_STORED) as archive:
+        for path in files.paths():
+            archive.write(os.path.join(files.path, path), path)
+    return out_path
+    
+## MAIN ########################################################################
+
+if __name__ == "__main__":
+    base = os.path.dirname(os.path.abspath(__file__))
+    out_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base, BUNDLE_NAME)
+    build_bundle(os.path.join(base, "_static"), out_path)
+    print "Wrote {} files to {}.".format(len(StaticBundle(out_path).paths()), out_path)
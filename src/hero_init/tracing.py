@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# tracing.py: Opt-in timing traces, exported in the Chrome Trace Event format.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## IMPORTS #####################################################################
+
+import os
+import time
+import itertools
+import threading
+from functools import wraps
+
+## CONSTANTS ###################################################################
+
+# Number of trace events kept before the oldest are overwritten.
+DEFAULT_CAPACITY = 100000
+
+## CLASSES #####################################################################
+
+class Tracer(object):
+    """
+    Fixed-capacity ring buffer of timed spans, recorded from any thread and
+    exported as Chrome Trace Event JSON, which can be loaded into
+    ``chrome://tracing`` or the Perfetto UI.
+    
+    Events are stored as tuples of ``(phase, name, category, timestamp,
+    duration, thread id, args)``, with times in microseconds.
+    """
+    
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._capacity = int(capacity)
+        self._events = [None] * self._capacity
+        # Taking the next slot is atomic, so no lock is needed.
+        self._counter = itertools.count()
+        self._thread_names = {}
+        
+    @property
+    def capacity(self):
+        return self._capacity
+        
+    def add(self, phase, name, cat, ts, dur=None, args=None):
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._thread_names:
+            self._thread_names[tid] = thread.name
+        self._events[next(self._counter) % self._capacity] = (
+            phase, name, cat, ts, dur, tid, args
+        )
+        
+    def trace_events(self):
+        """
+        Returns the events held, oldest first, as Chrome trace events.
+        """
+        pid = os.getpid()
+        events = [
+            {'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+             'args': {'name': name}}
+            for tid, name in self._thread_names.items()
+        ]
+        held = sorted(
+            (event for event in list(self._events) if event is not None),
+            key=lambda event: event[3]
+        )
+        for phase, name, cat, ts, dur, tid, args in held:
+            event = {
+                'ph': phase, 'name': name, 'cat': cat,
+                'ts': ts, 'pid': pid, 'tid': tid
+            }
+            if dur is not None:
+                event['dur'] = dur
+            if args:
+                event['args'] = args
+            events.append(event)
+        return events
+        
+    def export(self, filename):
+        import json
+        with open(filename, 'w') as f:
+            json.dump(
+                {'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'},
+                f
+            )
+
+class _Span(object):
+    __slots__ = ('_tracer', '_name', '_cat', '_args', '_start')
+    
+    def __init__(self, tracer, name, cat, args):
+        self._tracer = tracer
+        self._name = name
+        self._cat = cat
+        self._args = args
+        
+    def __enter__(self):
+        self._start = _now()
+        return self
+        
+    def __exit__(self, *exc_info):
+        end = _now()
+        self._tracer.add(
+            'X', self._name, self._cat, self._start, end - self._start, self._args
+        )
+        
+class _NullSpan(object):
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exc_info):
+        pass
+        
+_NULL_SPAN = _NullSpan()
+
+## FUNCTIONS ###################################################################
+
+# The running tracer, if tracing is on.
+_tracer = None
+
+def _now():
+    return int(time.time() * 1e6)
+    
+def start(capacity=DEFAULT_CAPACITY):
+    """
+    Starts tracing into a new ring buffer, discarding any previous trace.
+    """
+    global _tracer
+    _tracer = Tracer(capacity)
+    
+def stop():
+    """
+    Stops tracing, returning the :class:`Tracer` that was running, if any.
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+    
+def active():
+    return _tracer is not None
+    
+def save(filename):
+    """
+    Writes the running trace to a file, without stopping it. Returns
+    ``False`` if tracing is off.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return False
+    tracer.export(filename)
+    return True
+    
+def span(name, cat="hero_init", **args):
+    """
+    Returns a context manager timing its body as one span. When tracing is
+    off, this does nothing.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, cat, args)
+    
+def begin(name, cat="hero_init"):
+    """
+    Marks the start of a span whose end is marked by a call to :func:`end`
+    from the same thread, for spans that start and end in different
+    callbacks.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.add('B', name, cat, _now())
+        
+def end(name, cat="hero_init"):
+    tracer = _tracer
+    if tracer is not None:
+        tracer.add('E', name, cat, _now())
+    
+def traced(name, cat="hero_init"):
+    """
+    Decorator timing every call to the decorated function as a span.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return fn(*args, **kwargs)
+            with _Span(tracer, name, cat, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+# trie.py: Prefix tries for completing commands and names.
+##
+# © 2013 Christopher E. Granade (cgranade@gmail.com)
+#     
+# This file is a part of the hero_init project.
+# Licensed under the AGPL version 3.
+##
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+## CLASSES #####################################################################
+
+class _Node(object):
+    __slots__ = ('children', 'values', 'count')
+    
+    def __init__(self):
+        self.children = {}
+        # Values stored under exactly this key, in the order they were added.
+        self.values = []
+        # Number of values stored under this node or any node below it.
+        self.count = 0
+
+class PrefixTrie(object):
+    """
+    Maps string keys to values, allowing several values per key, and answers
+    questions about every key starting with a given prefix in time
+    proportional to the length of that prefix. Constructing a trie from an
+    iterable of keys stores each key as its own value.
+    """
+    
+    def __init__(self, keys=()):
+        self._root = _Node()
+        # Incremented on every change, so that callers can cache results.
+        self.generation = 0
+        for key in keys:
+            self.add(key, key)
+            
+    def __len__(self):
+        return self._root.count
+        
+    def __contains__(self, key):
+        node = self._find(key)
+        return node is not None and bool(node.values)
+        
+    def _find(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+        
+    def add(self, key, value):
+        node = self._root
+        node.count += 1
+        for char in key:
+            node = node.children.setdefault(char, _Node())
+            node.count += 1
+        node.values.append(value)
+        self.generation += 1
+        
+    def remove(self, key, value):
+        """
+        Removes the given value, compared by identity, from under ``key``.
+        Raises :class:`KeyError` if it isn't there.
+        """
+        path = [self._root]
+        for char in key:
+            node = path[-1].children.get(char)
+            if node is None:
+                raise KeyError(key)
+            path.append(node)
+        values = path[-1].values
+        for idx, stored in enumerate(values):
+            if stored is value:
+                del values[idx]
+                break
+        else:
+            raise KeyError(key)
+            
+        for node in path:
+            node.count -= 1
+        # Prune the branches left empty.
+        for depth in xrange(len(key), 0, -1):
+            if path[depth].count:
+                break
+            del path[depth - 1].children[key[depth - 1]]
+        self.generation += 1
+        
+    def get(self, key):
+        """
+        Returns the values stored under exactly ``key``, oldest first.
+        """
+        node = self._find(key)
+        return list(node.values) if node is not None else []
+        
+    def count(self, prefix=""):
+        """
+        Returns the number of values whose keys start with ``prefix``.
+        """
+        node = self._find(prefix)
+        return node.count if node is not None else 0
+        
+    def keys(self, prefix="", limit=None):
+        """
+        Returns the distinct keys starting with ``prefix`` in sorted order,
+        stopping after ``limit`` keys if given.
+        """
+        node = self._find(prefix)
+        found = []
+        if node is None:
+            return found
+        stack = [(prefix, node)]
+        while stack and (limit is None or len(found) < limit):
+            key, node = stack.pop()
+            if node.values:
+                found.append(key)
+            for char in sorted(node.children, reverse=True):
+                stack.append((key + char, node.children[char]))
+        return found
+        
+    def values(self, prefix="", limit=None):
+        """
+        Returns the values whose keys start with ``prefix``, ordered by key.
+        """
+        return [
+            value
+            for key in self.keys(prefix, limit)
+            for value in self._find(key).values
+        ][:limit]
+        
+    def extend_prefix(self, prefix):
+        """
+        Returns the longest string that starts with ``prefix`` and with which
+        every key starting with ``prefix`` also starts.
+        """
+        node = self._find(prefix)
+        if node is None:
+            return prefix
+        while not node.values and len(node.children) == 1:
+            char, node = next(node.children.iteritems())
+            prefix += char
+        return prefix